@@ -0,0 +1,141 @@
+from lxml import etree
+from array import array
+import collections
+import hashlib
+import json
+import os
+import time
+from .lxml_parser import TagPositions, getNodeKey, location_aware_lookup
+
+CACHE_VERSION = 1
+CACHE_EXTENSION = '.xpathcache'
+READ_SIZE = 1048576
+
+def cache_file_for(cache_dir, file_name):
+    """Return the path of the cache file for the given document."""
+    return os.path.join(cache_dir, hashlib.sha1(file_name.encode('UTF-8')).hexdigest() + CACHE_EXTENSION)
+
+def iter_document_nodes(root):
+    """Return a generator of all the nodes in the document, including comments and processing instructions outside the root element, in document order."""
+    for node in reversed(list(root.itersiblings(preceding=True))):
+        yield node
+    for node in root.iter():
+        yield node
+    for node in root.itersiblings():
+        yield node
+
+def snapshot_tag_positions(tag_positions):
+    """Copy the tag positions of a freshly parsed document, whose node ids are in document order, so that they can be saved while the document changes."""
+    return [array('q', getattr(tag_positions, name)) for name in TagPositions.ARRAYS]
+
+def save_parse_cache(cache_dir, file_name, file_stat, region, all_namespaces, positions):
+    """Save the namespaces and tag position arrays of the document parsed from the file to the cache, if the file still has the given stat. Return True if successful."""
+    stat = os.stat(file_name)
+    if stat.st_size != file_stat.st_size or stat.st_mtime != file_stat.st_mtime: # the file changed after it was read
+        return False
+    
+    sha1 = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(READ_SIZE), b''):
+            sha1.update(block)
+    
+    header = {
+        'version': CACHE_VERSION,
+        'file_name': file_name,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'sha1': sha1.hexdigest(),
+        'region': [region[0], region[1]],
+        'count': len(positions[0]),
+        'namespaces': list(all_namespaces.items()),
+    }
+    
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_file = cache_file_for(cache_dir, file_name)
+    temp_file = cache_file + '.tmp'
+    with open(temp_file, 'wb') as f:
+        f.write(json.dumps(header).encode('UTF-8') + b'\n')
+        for values in positions:
+            values.tofile(f)
+    os.replace(temp_file, cache_file) # so that a partially written cache is never read
+    return True
+
+def load_parse_cache(cache_dir, file_name, region):
+    """If the cache holds the tag positions for the current contents of the file, parsed from the given region, parse the file with the (much faster) standard parser and attach the cached positions and namespaces to it. Return the tree, or None if there was no usable cache."""
+    cache_file = cache_file_for(cache_dir, file_name)
+    try:
+        f = open(cache_file, 'rb')
+    except OSError:
+        return None
+    
+    with f:
+        try:
+            header = json.loads(f.readline().decode('UTF-8'))
+        except ValueError:
+            header = None
+        stat = os.stat(file_name)
+        if not header or header.get('version') != CACHE_VERSION or header['file_name'] != file_name or header['size'] != stat.st_size or header['mtime'] != stat.st_mtime:
+            f.close()
+            os.remove(cache_file) # the file has changed since it was cached
+            return None
+        if header['region'] != [region[0], region[1]]:
+            return None
+        
+        positions = []
+        for name in TagPositions.ARRAYS:
+            values = array('q')
+            values.fromfile(f, header['count'])
+            positions.append(values)
+    
+    # hash the file while parsing it, so it only needs to be read once
+    sha1 = hashlib.sha1()
+    parser = etree.XMLParser(collect_ids=False, huge_tree=True, remove_blank_text=False)
+    parser.set_element_class_lookup(location_aware_lookup)
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(READ_SIZE), b''):
+            sha1.update(block)
+            parser.feed(block)
+    root = parser.close()
+    if sha1.hexdigest() != header['sha1']:
+        os.remove(cache_file)
+        return None
+    
+    tag_positions = TagPositions()
+    for name, values in zip(TagPositions.ARRAYS, positions):
+        setattr(tag_positions, name, values)
+    node_id = -1
+    for node_id, node in enumerate(iter_document_nodes(root)):
+        tag_positions.ids[getNodeKey(node)] = node_id
+    if node_id + 1 != header['count']: # the location aware parser saw the document differently, i.e. comments inside the DTD
+        os.remove(cache_file) # it would never be usable, and would be hashed again every time the file is opened
+        return None
+    
+    tree = etree.ElementTree(root)
+    root.all_namespaces = collections.OrderedDict((prefix, uris) for prefix, uris in header['namespaces'])
+    root.tag_positions = tag_positions
+    os.utime(cache_file) # mark the cache as recently used
+    return tree
+
+def evict_parse_cache(cache_dir, max_size, max_age):
+    """Remove cache files that haven't been used for longer than max_age seconds, and then the least recently used ones until the total size is at most max_size bytes."""
+    try:
+        names = [name for name in os.listdir(cache_dir) if name.endswith(CACHE_EXTENSION)]
+    except OSError:
+        return
+    
+    entries = []
+    now = time.time()
+    for name in names:
+        path = os.path.join(cache_dir, name)
+        stat = os.stat(path)
+        if now - stat.st_mtime > max_age:
+            os.remove(path)
+        else:
+            entries.append((stat.st_mtime, stat.st_size, path))
+    
+    total = sum(entry[1] for entry in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        os.remove(path)
+        total -= size
@@ -1,7 +1,16 @@
 from lxml import etree
 from lxml.html import fromstring as fromhtmlstring
+from xml.sax.saxutils import quoteattr
+from array import array
+import bisect
 import collections
 import re
+import threading
+import itertools
+try:
+    import ctypes
+except ImportError: # not all builds of the Python interpreter embedded in Sublime Text include ctypes
+    ctypes = None
 
 def clean_html(html_soup):
     """Convert the given html tag soup string into a valid xml string."""
@@ -26,39 +35,273 @@ class TagPos(CommonEqualityMixin):
     
     def __repr__(self):
         return self.__class__.__name__ + ': ' + str(self.start_pos) + ', ' + str(self.end_pos)
-    
+
+
+def _getNodeAddress(node):
+    """Return the address of the libxml2 node underlying the lxml proxy, which stays the same for as long as the node exists, no matter how many times the proxy is recreated. See struct LxmlElement in lxml's public C API."""
+    return ctypes.c_void_p.from_address(id(node) + object.__basicsize__ + ctypes.sizeof(ctypes.c_void_p)).value
+
+def _canGetNodeAddresses():
+    """Check that the node address read from a proxy is stable when the proxy is recreated, and distinct between nodes."""
+    if ctypes is None:
+        return False
+    try:
+        parent = etree.Element('parent')
+        etree.SubElement(parent, 'child')
+        address = _getNodeAddress(parent[0])
+        return address is not None and address == _getNodeAddress(parent[0]) and address != _getNodeAddress(parent)
+    except Exception:
+        return False
+
+if _canGetNodeAddresses():
+    getNodeKey = _getNodeAddress
+else: # key on the proxy itself, which keeps it alive - otherwise, when the proxy is recreated, it can't be found again - see http://lxml.de/element_classes.html#element-initialization
+    getNodeKey = lambda node: node
+
+
+class TagPositions:
+    """The start and end positions of the open and close tags of the nodes in a document, stored in typed arrays indexed by node id. Node ids are assigned in document order as the nodes are parsed, and looked up by node key, so that the proxies don't need to be kept alive. Comments and processing instructions have the same open and close tag positions."""
+    ARRAYS = ('open_starts', 'open_ends', 'close_starts', 'close_ends', 'tag_name_ends')
+    
+    def __init__(self):
+        for name in self.ARRAYS:
+            setattr(self, name, array('q'))
+        self.ids = {}
+        self.unused = 0 # the number of ids belonging to nodes that have since been removed
+        self.segments = [0] # the first id of each run of ids whose open tags are in document order, i.e. one for the parsed document and one for each element spliced into it since
+    
+    def __len__(self):
+        return len(self.open_starts)
+    
+    def add(self, node, start, end, tag_name_end = -1):
+        """Add a node whose open tag is at the given position, and return it's id. Until it is set, the close tag is the same as the open tag."""
+        node_id = len(self.open_starts)
+        self.ids[getNodeKey(node)] = node_id
+        self.open_starts.append(start)
+        self.open_ends.append(end)
+        self.close_starts.append(start)
+        self.close_ends.append(end)
+        self.tag_name_ends.append(tag_name_end) # -1 when unknown, i.e. for comments
+        return node_id
+    
+    def remove(self, nodes):
+        """Forget the given nodes, i.e. because they are being replaced."""
+        for node in nodes:
+            del self.ids[getNodeKey(node)]
+            self.unused += 1
+    
+    def get_id(self, node):
+        return self.ids[getNodeKey(node)]
+    
+    def set_close(self, node, start, end, tag_name_end = None):
+        node_id = self.get_id(node)
+        self.close_starts[node_id] = start
+        self.close_ends[node_id] = end
+    
+    def get_range(self, node, position_type):
+        """Return the start and end position of the open or close tag of the node."""
+        node_id = self.get_id(node)
+        if position_type == 'open':
+            return (self.open_starts[node_id], self.open_ends[node_id])
+        else:
+            return (self.close_starts[node_id], self.close_ends[node_id])
+    
+    def get_tag_pos(self, node, position_type):
+        start, end = self.get_range(node, position_type)
+        return TagPos((start, start + 1), (end - 1, end))
+    
+    def is_self_closing(self, node):
+        node_id = self.get_id(node)
+        return self.open_starts[node_id] == self.close_starts[node_id]
+    
+    def extend(self, other):
+        """Append the positions of all the nodes from another instance, i.e. when the nodes are moved into this document."""
+        first_id = len(self)
+        for name in self.ARRAYS:
+            getattr(self, name).extend(getattr(other, name))
+        for key, node_id in other.ids.items():
+            self.ids[key] = first_id + node_id
+        self.unused += other.unused
+        self.segments.extend(first_id + segment for segment in other.segments)
+    
+    def shift(self, from_pos, delta, ancestors = ()):
+        """Move all the positions that are at or after from_pos by delta characters, in place. Only the nodes that open after the change, and the close tags of the given ancestors of the changed element, are visited."""
+        # when text is removed, the positions of the replaced nodes that fall inside it are clamped to where it ends, so that the open tag positions stay in document order within each segment
+        moved = from_pos + min(delta, 0)
+        def move(positions, start, end):
+            positions[start:end] = array('q', (pos + delta if pos >= from_pos else moved if pos > moved else pos for pos in positions[start:end]))
+        
+        bounds = self.segments + [len(self)]
+        for segment_start, segment_end in zip(bounds, bounds[1:]):
+            first = bisect.bisect_left(self.open_starts, moved, segment_start, segment_end)
+            if first < segment_end:
+                for name in self.ARRAYS:
+                    move(getattr(self, name), first, segment_end)
+        for node in ancestors:
+            node_id = self.get_id(node)
+            if self.open_starts[node_id] < moved: # otherwise, it was moved above
+                move(self.close_starts, node_id, node_id + 1)
+                move(self.close_ends, node_id, node_id + 1)
+
+
+def _splitClarkName(name):
+    """Split a name in {namespace uri}localname notation into the namespace uri (None if there isn't one) and the local name."""
+    if name[0] == '{':
+        end = name.index('}')
+        return (name[1:end], name[end + 1:])
+    return (None, name)
+
+def _clarkName(namespace, localname):
+    if namespace:
+        return '{' + namespace + '}' + localname
+    return localname
+
+class NameIndex:
+    """How many times each element name and attribute name is used in a document, so that queries for names that aren't used don't need to look through the document, and so that the names can be suggested without finding all the nodes that use them."""
+    def __init__(self):
+        self.elements = collections.Counter() # keyed by {namespace uri}localname and prefix
+        self.attributes = collections.Counter() # keyed by {namespace uri}localname
+    
+    def add(self, tag, prefix, attribute_names):
+        self.elements[(tag, prefix)] += 1
+        for name in attribute_names:
+            self.attributes[name] += 1
+    
+    def remove(self, nodes):
+        """Forget the names of the given nodes, i.e. because they are being replaced."""
+        for node in nodes:
+            if isinstance(node, LocationAwareElement): # skip comments
+                self.elements[(node.tag, node.prefix)] -= 1
+                for name in node.attrib:
+                    self.attributes[name] -= 1
+        self.elements += collections.Counter() # remove names that are no longer used
+        self.attributes += collections.Counter()
+    
+    def extend(self, other):
+        """Add the names from another instance, i.e. when the nodes are moved into this document."""
+        self.elements.update(other.elements)
+        self.attributes.update(other.attributes)
+    
+    def count_elements(self, namespace, localname):
+        tag = _clarkName(namespace, localname)
+        return sum(count for key, count in self.elements.items() if key[0] == tag)
+    
+    def has_attribute(self, namespace, localname):
+        return _clarkName(namespace, localname) in self.attributes
+    
+    def element_names(self):
+        """Return the namespace uri, prefix and local name of each element name used in the document."""
+        for tag, prefix in self.elements:
+            namespace, localname = _splitClarkName(tag)
+            yield (namespace, prefix, localname)
+    
+    def attribute_names(self):
+        """Return the namespace uri and local name of each attribute name used in the document."""
+        return (_splitClarkName(name) for name in self.attributes)
+    
+    @classmethod
+    def for_tree(cls, root):
+        """Return the name index of the document the root element belongs to, building it if the document wasn't parsed with one, i.e. when it was loaded from the parse cache."""
+        if not hasattr(root, 'name_index'):
+            name_index = cls()
+            for element in root.iter(tag=etree.Element):
+                name_index.add(element.tag, element.prefix, element.attrib)
+            root.name_index = name_index
+        return root.name_index
+
 
 class LocationAwareElement(etree.ElementBase):
-    open_tag_pos = None
-    close_tag_pos = None
+    @property
+    def open_tag_pos(self):
+        return getTagPositions(self).get_tag_pos(self, 'open')
+    
+    @property
+    def close_tag_pos(self):
+        return getTagPositions(self).get_tag_pos(self, 'close')
     
     def is_self_closing(self):
         """If the start and end tag positions are the same, then it is self closing."""
-        return self.open_tag_pos == self.close_tag_pos
+        return getTagPositions(self).is_self_closing(self)
 
 
 class LocationAwareComment(etree.CommentBase):
-    tag_pos = None
+    @property
+    def tag_pos(self):
+        return getTagPositions(self).get_tag_pos(self, 'open')
 
 
 class LocationAwareProcessingInstruction(etree.PIBase):
-    tag_pos = None
+    @property
+    def tag_pos(self):
+        return getTagPositions(self).get_tag_pos(self, 'open')
+
+
+location_aware_lookup = etree.ElementDefaultClassLookup(element=LocationAwareElement, comment=LocationAwareComment, pi=LocationAwareProcessingInstruction)
+# a parser that is only used to create elements, so that the documents they end up in recreate their proxies using the location aware classes
+_node_factory = etree.XMLParser()
+_node_factory.set_element_class_lookup(location_aware_lookup)
+
+
+class MarkupSyntax:
+    """The strings and patterns that LocationAwareXMLParser scans the document for, as either str or UTF-8 encoded bytes."""
+    _instances = {}
+    
+    def __init__(self, encode):
+        delimited_markup = tuple((encode(opener), encode(terminator)) for opener, terminator in LocationAwareXMLParser.DELIMITED_MARKUP)
+        self.delimited_markup = delimited_markup
+        self.comment = delimited_markup[0]
+        self.cdata = delimited_markup[1]
+        self.pi = delimited_markup[2]
+        self.delimited_markup_starts = (encode('!'), encode('?'))
+        self.lt = encode('<')
+        self.slash = encode('/')
+        self.doctype_start = encode('<!')
+        self.internal_subset_start = encode('[')
+        for name in ('RE_XML_DECLARATION', 'RE_TAG', 'RE_DOCTYPE', 'RE_INTERNAL_SUBSET'):
+            pattern = getattr(LocationAwareXMLParser, name)
+            if encode is not str:
+                pattern = re.compile(encode(pattern.pattern), pattern.flags & ~re.UNICODE)
+            setattr(self, name.lower(), pattern)
+        self.split_point = len
+        self.re_extra_bytes = None # positions in str are already character positions
+        if encode is not str:
+            self.split_point = findSafeSplitPoint
+            self.re_extra_bytes = re.compile(rb'[\x80-\xbf]|(?<=\r)\n') # the continuation bytes of UTF-8 encoded characters, and the LF of CR LF line endings, which are a single character in a Sublime Text view
+    
+    @classmethod
+    def for_type(cls, chunk_type):
+        if chunk_type not in cls._instances:
+            cls._instances[chunk_type] = cls(str if chunk_type is str else lambda text: text.encode('UTF-8'))
+        return cls._instances[chunk_type]
+
+def findSafeSplitPoint(data):
+    """Return the position at which to split the UTF-8 encoded bytes, so that the characters before it can be counted without separating the bytes of a character, or a CR LF line ending."""
+    pos = len(data)
+    while pos > 0 and len(data) - pos < 3 and 0x80 <= data[pos - 1] < 0xC0: # continuation bytes at the end could belong to an incomplete character
+        pos -= 1
+    if pos > 0 and data[pos - 1] >= 0xC0: # as could the byte that starts it
+        pos -= 1
+    elif pos == len(data) and data.endswith(b'\r'):
+        pos -= 1
+    return pos
 
 
 # http://stackoverflow.com/questions/36246014/lxml-use-default-class-element-lookup-and-treebuilder-parser-target-at-the-sam
 class LocationAwareXMLParser:
-    RE_SPLIT_XML = re.compile(r'<!\[CDATA\[|\]\]>|[<>]')
+    DELIMITED_MARKUP = (('<!--', '-->'), ('<![CDATA[', ']]>'), ('<?', '?>')) # markup whose end can be found by searching for the terminator
+    RE_XML_DECLARATION = re.compile(r'<\?xml\s')
+    RE_TAG = re.compile(r'''<(/?)([^\s/>!?]+)[^>"']*(?:(?:"[^"]*"|'[^']*')[^>"']*)*>''')
+    RE_DOCTYPE = re.compile(r'''<!DOCTYPE[^\[>"']*(?:(?:"[^"]*"|'[^']*')[^\[>"']*)*[\[>]''')
+    RE_INTERNAL_SUBSET = re.compile(r'''\s+|%[^;]*;|(<!--.*?-->|<\?.*?\?>)|<![^>"']*(?:(?:"[^"]*"|'[^']*')[^>"']*)*>|(\]\s*>)''', re.DOTALL)
     
     def __init__(self, position_offset = 0, **parser_options):
-        def getLocation(index=None):
-            if index is None:
-                index = -3
-            return TagPos(self._positions[index], self._positions[-1])
+        def getLocation():
+            return self._markup_positions.popleft()
         
         class Target:
             start = lambda t, tag, attrib=None, nsmap=None: self.element_start(tag, attrib, nsmap, getLocation())
             end = lambda t, tag: self.element_end(tag, getLocation())
-            data = lambda t, data: self.text_data(data, getLocation(-1))
+            data = lambda t, data: self.text_data(data)
             comment = lambda t, comment: self.comment(comment, getLocation())
             pi = lambda t, target, data: self.pi(target, data, getLocation())
             doctype = lambda t, name, public_identifier, system_identifier: self.doctype(name, public_identifier, system_identifier, getLocation())
@@ -69,32 +312,115 @@ class LocationAwareXMLParser:
         self._reset()
     
     def _reset(self):
-        self._position_offset = self._initial_position_offset
-        self._remainder = ''
-        self._positions = []
+        self._position_offset = self._initial_position_offset # the character position of the remainder
+        self._remainder = None
+        self._pending = None # when the remainder starts with markup whose terminator hasn't arrived yet, the chunks received since, which are only joined together once it does
+        self._pending_terminator = None
+        self._pending_tail = None # the end of the text searched for the terminator, in case the terminator is split between chunks
+        self._in_internal_subset = False
+        self._markup_positions = collections.deque() # the start and end positions of markup that the target has yet to be notified about
     
     def feed(self, chunk):
-        start_search_at = len(self._remainder)
-        chunk = self._remainder + chunk
-        self._remainder = ''
-        chunk_offset = 0
-        
-        for result in self.RE_SPLIT_XML.finditer(chunk, start_search_at): # find the next sigificant XML control char, so we can manually know the location
-            self._positions.append((self._position_offset + chunk_offset, self._position_offset + result.start()))
-            self._feed(chunk[chunk_offset:result.start()])
+        """Feed a chunk of the document to the parser. The chunks can be str or, to avoid decoding and encoding them again, UTF-8 encoded bytes, but not a mixture of both."""
+        if self._remainder is None:
+            self._remainder = chunk[0:0] # an empty str or bytes
+            self._syntax = MarkupSyntax.for_type(type(chunk))
+        if self._pending_terminator is None:
+            self._scan(self._remainder + chunk) # the positions must be known before lxml reaches the markup and notifies the target
+        else: # rather than join the text of e.g. a large CDATA section together again for every chunk, only search the new chunk for the terminator
+            terminator = self._pending_terminator
+            searched = self._pending_tail + chunk
+            self._pending.append(chunk)
+            if terminator in searched:
+                text = chunk[0:0].join(self._pending)
+                self._pending_terminator = None
+                self._pending = None
+                self._scan(text)
+            else:
+                self._pending_tail = searched[len(searched) - len(terminator) + 1:]
+        self._feed(chunk)
+    
+    def _scan(self, text):
+        """Record the start and end positions of the markup in the text that the parser target will be notified about, in document order, and for tags, where the tag name ends. Incomplete markup at the end of the text is kept to be scanned with the next chunk."""
+        syntax = self._syntax
+        found = [] # positions relative to the start of the text
+        pos = 0
+        while True:
+            if self._in_internal_subset:
+                delimited = next((markup for markup in (syntax.comment, syntax.pi) if text.startswith(markup[0], pos)), None)
+                if delimited is not None and text.find(delimited[1], pos + len(delimited[0])) == -1: # wait for the rest of it, otherwise a > inside it would be taken as the end of a declaration
+                    self._waitForTerminator(text, pos, delimited)
+                    break
+                match = syntax.re_internal_subset.match(text, pos)
+                if match is None:
+                    break
+                if match.group(1) is not None: # comments and processing instructions in the internal subset are reported to the target too
+                    found.append((match.start(), match.end()))
+                elif match.group(2) is not None:
+                    self._in_internal_subset = False
+                pos = match.end()
+                continue
+            
+            pos = text.find(syntax.lt, pos)
+            if pos == -1:
+                pos = len(text)
+                break
             
-            self._positions.append((self._position_offset + result.start(), self._position_offset + result.end()))
-            self._feed(chunk[result.start():result.end()])
-            chunk_offset = result.end()
-        self._remainder = chunk[chunk_offset:]
-        self._position_offset += chunk_offset
+            delimited = None
+            if text[pos + 1:pos + 2] in syntax.delimited_markup_starts:
+                delimited = next((markup for markup in syntax.delimited_markup if text.startswith(markup[0], pos)), None)
+            if delimited is not None:
+                opener, terminator = delimited
+                end = text.find(terminator, pos + len(opener))
+                if end == -1:
+                    self._waitForTerminator(text, pos, delimited)
+                    break
+                end += len(terminator)
+                if delimited is not syntax.cdata and not (delimited is syntax.pi and syntax.re_xml_declaration.match(text, pos)): # CDATA sections are reported as text, and the xml declaration is not reported at all
+                    found.append((pos, end))
+                pos = end
+            else:
+                is_doctype = text.startswith(syntax.doctype_start, pos)
+                match = (syntax.re_doctype if is_doctype else syntax.re_tag).match(text, pos)
+                if match is None:
+                    break
+                location = (pos, match.end()) if is_doctype else (pos, match.end(), match.end(2))
+                found.append(location)
+                if is_doctype:
+                    self._in_internal_subset = text[match.end() - 1:match.end()] == syntax.internal_subset_start
+                elif not match.group(1) and text[match.end() - 2:match.end() - 1] == syntax.slash: # a self closing tag is reported as both the start and the end of the element
+                    found.append(location)
+                pos = match.end()
+        
+        if pos == len(text):
+            pos = syntax.split_point(text)
+        offset = self._position_offset
+        extra_bytes = None
+        if syntax.re_extra_bytes is not None:
+            extra_bytes = [match.start() for match in syntax.re_extra_bytes.finditer(text, 0, pos)]
+        if not extra_bytes: # each byte is a character
+            self._markup_positions.extend(tuple(offset + position for position in location) for location in found)
+            self._position_offset = offset + pos
+        else: # convert the byte offsets to character positions
+            count = bisect.bisect_left
+            self._markup_positions.extend(tuple(offset + position - count(extra_bytes, position) for position in location) for location in found)
+            self._position_offset = offset + pos - count(extra_bytes, pos)
+        self._remainder = text[pos:]
+        if self._pending_terminator is not None:
+            self._pending = [self._remainder]
+    
+    def _waitForTerminator(self, text, pos, delimited):
+        """Keep the markup at pos, which hasn't been terminated yet, and the chunks that follow it, until the terminator arrives."""
+        opener, terminator = delimited
+        self._pending_terminator = terminator
+        self._pending_tail = text[max(pos + len(opener), len(text) - len(terminator) + 1):]
     
     def _feed(self, text):
-        self._parser.feed(bytes(text, 'UTF-8')) # feed as bytes, otherwise doesn't work on OSX, and encoding declarations in the prolog can cause exceptions - http://lxml.de/parsing.html#python-unicode-strings
+        if not isinstance(text, bytes):
+            text = bytes(text, 'UTF-8') # feed as bytes, otherwise doesn't work on OSX, and encoding declarations in the prolog can cause exceptions - http://lxml.de/parsing.html#python-unicode-strings
+        self._parser.feed(text)
     
     def close(self):
-        self._positions.append((self._position_offset, self._position_offset + len(self._remainder)))
-        self._feed(self._remainder)
         result = self._parser.close()
         self._reset()
         return result
@@ -124,12 +450,13 @@ class LocationAwareXMLParser:
 class LocationAwareTreeBuilder(LocationAwareXMLParser):
     def _reset(self):
         super()._reset()
-        self._all_elements = [] # necessary to keep the "proxy" alive, so it will keep our custom class attributes - otherwise, when the class instance is recreated, it no longer has the position information - see http://lxml.de/element_classes.html#element-initialization
         self._element_stack = []
         self._text = []
         self._most_recent = None
         self._in_tail = None
         self._all_namespaces = collections.OrderedDict()
+        self._tag_positions = TagPositions()
+        self._name_index = NameIndex()
         self._addprevious = []
         self._root = None
     
@@ -151,19 +478,19 @@ class LocationAwareTreeBuilder(LocationAwareXMLParser):
                 namespaces.append(nsmap[prefix])
         
         self._flush()
-        self._appendNode(self.create_element(tag, attrib, nsmap))
+        self._appendNode(self.create_element(tag, attrib, nsmap), location)
+        self._name_index.add(tag, self._most_recent.prefix, attrib or ())
         self._element_stack.append(self._most_recent)
-        self._most_recent.open_tag_pos = location
         self._in_tail = False
     
     def create_element(self, tag, attrib=None, nsmap=None):
-        LocationAwareElement.TAG = tag
-        return LocationAwareElement(attrib=attrib, nsmap=nsmap)
+        nsmap = dict((prefix or None, nsmap[prefix]) for prefix in nsmap) # newer versions of lxml report the default namespace with an empty prefix, which can't be used to create an element
+        return _node_factory.makeelement(tag, attrib, nsmap)
     
     def element_end(self, tag, location=None):
         self._flush()
         self._most_recent = self._element_stack.pop()
-        self._most_recent.close_tag_pos = location
+        self._tag_positions.set_close(self._most_recent, *location)
         self._in_tail = True
     
     def text_data(self, data, location=None):
@@ -171,14 +498,12 @@ class LocationAwareTreeBuilder(LocationAwareXMLParser):
     
     def pi(self, target, data, location=None):
         self._flush()
-        self._appendNode(self.create_pi(target, data))
-        self._most_recent.tag_pos = location
+        self._appendNode(self.create_pi(target, data), location)
         self._in_tail = True
     
     def comment(self, text, location=None):
         self._flush()
-        self._appendNode(self.create_comment(text))
-        self._most_recent.tag_pos = location
+        self._appendNode(self.create_comment(text), location)
         self._in_tail = True
     
     def create_comment(self, text):
@@ -187,7 +512,7 @@ class LocationAwareTreeBuilder(LocationAwareXMLParser):
     def create_pi(self, target, data):
         return LocationAwareProcessingInstruction(target, data)
     
-    def _appendNode(self, node):
+    def _appendNode(self, node, location):
         if self._element_stack: # if we have anything on the stack
             self._element_stack[-1].append(node) # append the node as a child to the last/top element on the stack
         elif self._root is None and isinstance(node, etree.ElementBase):
@@ -200,12 +525,12 @@ class LocationAwareTreeBuilder(LocationAwareXMLParser):
         else:
             # store this element to add before the root node when we encounter it
             self._addprevious.append(node)
-        self._all_elements.append(node)
+        self._tag_positions.add(node, *location)
         self._most_recent = node
     
     def document_end(self):
-        """Return the root node and a list of all elements (and comments) found in the document, to keep their proxy alive."""
-        return (self._root, self._all_namespaces, self._all_elements)
+        """Return the root node, the namespaces, the positions of the tags and the names found in the document."""
+        return (self._root, self._all_namespaces, self._tag_positions, self._name_index)
 
 
 def lxml_etree_parse_xml_string_with_location(xml_chunks, position_offset = 0, should_stop = None):
@@ -219,23 +544,68 @@ def lxml_etree_parse_xml_string_with_location(xml_chunks, position_offset = 0, s
             break
         target.feed(chunk)
     
-    root, all_namespaces, all_elements = target.close()
+    root, all_namespaces, tag_positions, name_index = target.close()
     tree = etree.ElementTree(root)
     
     root.all_namespaces = all_namespaces
+    root.tag_positions = tag_positions # the root proxy is kept alive by the tree
+    root.name_index = name_index
     
-    return (tree, all_elements)
+    return tree
+
+def lxml_etree_parse_xml_fragment_with_location(xml_chunks, position_offset, namespaces):
+    """Parse the xml chunks, which should contain exactly one element, in the scope of the given namespace declarations. Return the element and the positions of the tags and the names belonging to it - which need adding to those of the document the element is moved to."""
+    # wrap the fragment in an element that declares the namespaces in scope, so that prefixes declared by the ancestors of the original element can be resolved
+    wrapper_open = '<fragment'
+    for prefix in namespaces:
+        wrapper_open += ' xmlns' + (':' + prefix if prefix else '') + '=' + quoteattr(namespaces[prefix])
+    wrapper_open += '>'
+    
+    target = LocationAwareTreeBuilder(position_offset=position_offset - len(wrapper_open), collect_ids=False, huge_tree=True, remove_blank_text=False)
+    target.feed(wrapper_open)
+    for chunk in xml_chunks:
+        target.feed(chunk)
+    target.feed('</fragment>')
+    wrapper, all_namespaces, tag_positions, name_index = target.close()
+    
+    if len(wrapper) != 1 or not isinstance(wrapper[0], LocationAwareElement) or wrapper.text or wrapper[0].tail:
+        raise ValueError('The fragment does not consist of exactly one element')
+    tag_positions.remove([wrapper])
+    name_index.remove([wrapper])
+    return (wrapper[0], tag_positions, name_index)
+
+def getNamespaceDeclarations(node):
+    """Return the namespace prefixes and uris declared by the element and its descendants, in document order."""
+    declarations = []
+    for element in node.iter(tag=etree.Element):
+        parent_namespaces = element.getparent().nsmap
+        declared = sorted((prefix or '', uri) for prefix, uri in element.nsmap.items() if parent_namespaces.get(prefix, None) != uri)
+        if declared: # so that adding or removing elements that don't declare any namespaces makes no difference
+            declarations.append(declared)
+    return declarations
+
+def getSmallestElementContaining(node, begin, end):
+    """Given an element and a range, return the innermost element (starting from the given one) whose open and close tags surround the range, or None if the given element doesn't surround it."""
+    if not getNodeTagRange(node, 'open')[0] < begin or not end < getNodeTagRange(node, 'close')[1]:
+        return None
+    for child in node.iterchildren(tag=etree.Element):
+        if getNodeTagRange(child, 'open')[0] >= end: # the children are sorted, so no further children can contain the range
+            break
+        found = getSmallestElementContaining(child, begin, end)
+        if found is not None:
+            return found
+    return node
 
 # TODO: consider moving to LocationAwareElement class
-def getNodeTagRange(node, position_type):
+def getTagPositions(node):
+    """Return the tag positions of the document that the node belongs to."""
+    return node.getroottree().getroot().tag_positions
+
+def getNodeTagRange(node, position_type, tag_positions = None):
     """Given a node and position type (open or close), return the node's position."""
-    pos = None
-    if isinstance(node, LocationAwareComment) or isinstance(node, LocationAwareProcessingInstruction):
-        pos = node.tag_pos
-    else:
-        pos = getattr(node, position_type + '_tag_pos')
-    #assert pos is not None, repr(node) + ' ' + position_type
-    return (pos.start_pos[0], pos.end_pos[1])
+    if tag_positions is None:
+        tag_positions = getTagPositions(node)
+    return tag_positions.get_range(node, position_type)
 
 def getRelativeNode(relative_to, direction):
     """Given a node and a direction, return the node that is relative to it in the specified direction, or None if there isn't one."""
@@ -297,19 +667,154 @@ def unique_namespace_prefixes(namespaces, replaceNoneWith = 'default', start = 1
     
     return unique
 
-def get_results_for_xpath_query(query, tree, context = None, namespaces = None, **variables):
-    """Given a query string and a document trees and optionally some context elements, compile the xpath query and execute it."""
+class CompiledXPathCache:
+    """A bounded cache of compiled xpath queries, which discards the least recently used query when it is full. Counts hits and misses, so the saving can be seen."""
+    def __init__(self, max_size = 256):
+        self.max_size = max_size
+        self.compiled = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.not_node_sets = collections.OrderedDict() # queries that are known not to return a node-set, so can't be limited
+        self._lock = threading.Lock()
+    
+    def _key(self, query, nsmap):
+        return (query, frozenset(nsmap.items()), frozenset(etree.FunctionNamespace(None))) # the extension functions that are registered affect how the query is compiled
+    
+    def get(self, query, nsmap):
+        """Return the query compiled with the given namespaces, compiling it if it isn't already cached."""
+        key = self._key(query, nsmap)
+        with self._lock:
+            xpath = self.compiled.get(key, None)
+            if xpath is not None:
+                self.compiled.move_to_end(key)
+                self.hits += 1
+                return xpath
+            self.misses += 1
+        
+        xpath = etree.XPath(query, namespaces = nsmap) # compile outside the lock, and let syntax errors propagate without caching anything
+        with self._lock:
+            self.compiled[key] = xpath
+            while len(self.compiled) > self.max_size:
+                self.compiled.popitem(last = False)
+        return xpath
+    
+    def get_limited(self, query, nsmap, max_results):
+        """Return the query compiled so that it only returns the first max_results nodes, or None if the query is known not to return a node-set."""
+        with self._lock:
+            if self._key(query, nsmap) in self.not_node_sets:
+                return None
+        return self.get('(' + query + ')[position() <= ' + str(max_results) + ']', nsmap)
+    
+    def set_not_node_set(self, query, nsmap):
+        """Remember that the query doesn't return a node-set, so that it isn't limited again."""
+        with self._lock:
+            self.not_node_sets[self._key(query, nsmap)] = True
+            while len(self.not_node_sets) > self.max_size:
+                self.not_node_sets.popitem(last = False)
+    
+    def clear(self):
+        with self._lock:
+            self.compiled.clear()
+            self.not_node_sets.clear()
+    
+    def __str__(self):
+        return str(self.hits) + ' hits, ' + str(self.misses) + ' misses, ' + str(len(self.compiled)) + ' of ' + str(self.max_size) + ' cached'
+
+compiled_xpath_cache = CompiledXPathCache()
+
+NCNAME = r'[^\W\d][\w.-]*' # a name without a prefix, which can't start with a digit, . or -, so that i.e. //. and //.. aren't taken to be names
+RE_SIMPLE_DESCENDANT_QUERY = re.compile(r'''^\s*//(?:(\*)|(?:({0}):)?({0}))\s*(?:\[\s*@(?:({0}):)?({0})\s*(?:=\s*(?:"[^"]*"|'[^']*')\s*)?\]\s*)?$'''.format(NCNAME))
+RE_SIMPLE_DESCENDANT_ATTRIBUTE_QUERY = re.compile(r'^\s*//@(?:({0}):)?({0})\s*$'.format(NCNAME))
+
+def namespaces_to_nsmap(namespaces):
+    """Convert the unique namespace prefixes map to the prefix to uri map expected by lxml."""
     nsmap = {}
     if namespaces is not None:
         for prefix in namespaces.keys():
             if namespaces[prefix][0] != '':
                 nsmap[prefix] = namespaces[prefix][0]
+    return nsmap
+
+def plan_xpath_query(query, tree, nsmap):
+    """Check whether the query can be answered without the xpath engine, by using the name index of the document. Return a tuple of the generator of the results in document order, and the number of results if it is known without generating them - or None if the query should be executed by the xpath engine.
+    
+    Queries that select all elements or all elements with a given name, i.e. //* or //prefix:name, are answered by iterating the tree, which can stop as soon as enough results have been found. Queries for element or attribute names that aren't used in the document, including //name[@attribute] and //name[@attribute = 'value'] and //@attribute, are answered without looking at the document at all."""
+    def resolve(prefix, localname, default):
+        """Return the namespace uri and local name of a name used in the query, or None if the prefix is undefined."""
+        if prefix is None:
+            return (default, localname)
+        if prefix in nsmap:
+            return (nsmap[prefix], localname)
+        return None
+    
+    if not isinstance(tree, etree._ElementTree):
+        tree = tree.getroottree()
+    
+    match = RE_SIMPLE_DESCENDANT_ATTRIBUTE_QUERY.match(query)
+    if match is not None:
+        attribute = resolve(match.group(1), match.group(2), None)
+        if attribute is None or NameIndex.for_tree(tree.getroot()).has_attribute(*attribute):
+            return None
+        return (iter(()), 0)
+    
+    match = RE_SIMPLE_DESCENDANT_QUERY.match(query)
+    if match is None:
+        return None
+    
+    if match.group(1) is not None:
+        element = None
+    else:
+        element = resolve(match.group(2), match.group(3), None) # an unprefixed name matches elements in no namespace
+        if element is None:
+            return None # let the xpath engine report the undefined prefix
+    attribute = None
+    if match.group(5) is not None:
+        attribute = resolve(match.group(4), match.group(5), None) # unprefixed attributes are never in a namespace
+        if attribute is None:
+            return None
+    
+    name_index = NameIndex.for_tree(tree.getroot())
+    count = sum(name_index.elements.values())
+    if element is not None:
+        count = name_index.count_elements(*element)
+    if count == 0 or attribute is not None and not name_index.has_attribute(*attribute):
+        return (iter(()), 0)
+    if attribute is not None: # the xpath engine is faster at checking attributes
+        return None
+    if element is None:
+        return (tree.iter(etree.Element), count)
+    return (tree.iter(_clarkName(*element)), count)
+
+def get_results_for_xpath_query(query, tree, context = None, namespaces = None, max_results = None, **variables):
+    """Given a query string and a document trees and optionally some context elements, compile the xpath query (or reuse the previously compiled one) and execute it. If max_results is given, only the first max_results nodes are returned, doing as little work as possible to find them."""
+    nsmap = namespaces_to_nsmap(namespaces)
+    
+    xpath = compiled_xpath_cache.get(query, nsmap) # always compile the query as given, so that syntax errors are reported for it
     
-    xpath = etree.XPath(query, namespaces = nsmap)
+    plan = plan_xpath_query(query, tree, nsmap)
+    if plan is not None:
+        return list(itertools.islice(plan[0], max_results))
+    
+    if max_results is not None:
+        limited_xpath = compiled_xpath_cache.get_limited(query, nsmap, max_results)
+        if limited_xpath is not None:
+            try:
+                return execute_xpath_query(tree, limited_xpath, context, **variables)
+            except etree.XPathEvalError: # the query doesn't return a node-set, so execute it as it is
+                compiled_xpath_cache.set_not_node_set(query, nsmap)
     
     results = execute_xpath_query(tree, xpath, context, **variables)
     return results
 
+def count_results_for_xpath_query(query, tree, context = None, namespaces = None, **variables):
+    """Return the number of nodes the query returns, without creating them in Python."""
+    nsmap = namespaces_to_nsmap(namespaces)
+    plan = plan_xpath_query(query, tree, nsmap)
+    if plan is not None and plan[1] is not None:
+        return plan[1]
+    xpath = compiled_xpath_cache.get('count(' + query + ')', nsmap)
+    return int(execute_xpath_query(tree, xpath, context, **variables)[0])
+
 def execute_xpath_query(tree, xpath, context_node = None, **variables):
     """Execute the precompiled xpath query on the tree and return the results as a list."""
     if context_node is None: # explicitly check for None rather than using "or", because it is treated as a list
@@ -2,31 +2,41 @@ import sublime
 from .lxml_parser import *
 from .sublime_helper import get_scopes
 import re
+import os
+import bisect
+from array import array
+import mmap
+import codecs
 
 RE_TAG_NAME_END_POS = re.compile('[>\s/]')
 RE_TAG_ATTRIBUTES = re.compile('\s+((\w+(?::\w+)?)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'))')
+OPEN_TAG_READ_AHEAD = 1048576 # the most characters to read from the view at a time when looking at the open tags of many nodes
+OPEN_TAG_MIN_READ_AHEAD = 4096 # how many characters to read past an open tag when the previous one read was far away
 
 # TODO: consider subclassing etree.ElementBase and adding as methods to that
-def getNodeTagRegion(view, node, position_type):
+def getNodeTagRegion(view, node, position_type, tag_positions = None):
     """Given a view, a node and a position type (open or close), return the region that relates to the node's position."""
-    return sublime.Region(*getNodeTagRange(node, position_type))
+    return sublime.Region(*getNodeTagRange(node, position_type, tag_positions))
 
-def getNodePosition(view, node):
+def getNodePosition(view, node, tag_positions = None):
     """Given a view and a node, return the regions that represent the positions of the open and close tags."""
-    open_pos = getNodeTagRegion(view, node, 'open')
-    close_pos = getNodeTagRegion(view, node, 'close')
+    if tag_positions is None:
+        tag_positions = getTagPositions(node)
+    open_pos = getNodeTagRegion(view, node, 'open', tag_positions)
+    close_pos = getNodeTagRegion(view, node, 'close', tag_positions)
     
     return (open_pos, close_pos)
 
 def getNodePositions(view, node):
     """Generator for distinct positions within this node."""
-    open_pos, close_pos = getNodePosition(view, node)
+    tag_positions = getTagPositions(node)
+    open_pos, close_pos = getNodePosition(view, node, tag_positions)
     
     pos = open_pos.begin()
     
     for child in node.iterchildren():
         if isinstance(child, LocationAwareElement): # skip comments
-            child_open_pos, child_close_pos = getNodePosition(view, child)
+            child_open_pos, child_close_pos = getNodePosition(view, child, tag_positions)
             yield (node, pos, child_open_pos.begin(), True)
             pos = child_close_pos.end()
             yield (child, child_open_pos.begin(), pos, len(child) == 0)
@@ -36,64 +46,105 @@ def getNodePositions(view, node):
 def regionIntersects(outer, inner, include_beginning):
     return outer.intersects(inner) or (include_beginning and inner.empty() and outer.contains(inner.begin())) # only include beginning if selection size is empty. so can select <hello>text|<world />|</hello> and xpath will show as 'hello/world' rather than '/hello'
 
+def getChildSpans(node, tag_positions):
+    """Return the sorted start and end positions of the child elements of the node, their indexes amongst all the node's children, whether they have children of their own, how many children the node has, and the most recently used child and its index. These are computed once per node and cached with the tree, so that the children at a position can be found by binary search."""
+    root = node.getroottree().getroot()
+    if not hasattr(root, 'child_spans'):
+        root.child_spans = {}
+    key = getNodeKey(node)
+    spans = root.child_spans.get(key, None)
+    if spans is None:
+        starts = array('q')
+        ends = array('q')
+        indexes = array('q')
+        has_children = []
+        child_count = 0
+        for index, child in enumerate(node.iterchildren()):
+            child_count += 1
+            if isinstance(child, LocationAwareElement): # skip comments
+                child_id = tag_positions.get_id(child)
+                starts.append(tag_positions.open_starts[child_id])
+                ends.append(tag_positions.close_ends[child_id])
+                indexes.append(index)
+                has_children.append(len(child) > 0)
+        spans = (starts, ends, indexes, has_children, child_count, [None, None])
+        root.child_spans[key] = spans
+    return spans
+
+def getChildAt(node, spans, index):
+    """Return the child of the node at the given index, by walking from whichever is closer: the first child, the last child or the most recently used child. lxml has to walk through the children to find one by index, so this makes moving between nearby siblings quick."""
+    child_count = spans[4]
+    last_index, last_child = spans[5]
+    from_end = child_count - 1 - index
+    if last_child is not None and abs(index - last_index) * 10 < min(index, from_end): # stepping through siblings in Python is about ten times slower than lxml stepping through them
+        siblings = last_child.itersiblings(preceding = index < last_index)
+        child = last_child
+        for step in range(abs(index - last_index)):
+            child = next(siblings)
+    elif index <= from_end:
+        child = node[index]
+    else:
+        child = node[-1 - from_end]
+    spans[5][0:2] = [index, child]
+    return child
+
+def clearChildSpans(root):
+    """Discard the child spans cached for the tree, after its elements or their positions have changed."""
+    if hasattr(root, 'child_spans'):
+        del root.child_spans
+
 # TODO: consider subclassing tree? and moving function to that class
 def getNodesAtPositions(view, roots, positions):
-    """Given a sorted list of trees and non-overlapping positions, return the nodes that relate to each position - efficiently, without searching through unnecessary children and stop once all are found."""
+    """Given a sorted list of trees and non-overlapping positions, return the nodes that relate to each position - efficiently, by binary searching the children of each node for the positions inside it, rather than looking through all of them."""
     
-    def relevance(span, start_index, max_index, include_beginning):
-        """Look through all sorted positions from the starting index to the max, to find those that match the span. If there is a gap, stop looking."""
-        found_one = False
-        for index in range(start_index, max_index + 1):
-            if regionIntersects(span, positions[index], include_beginning):
-                yield index
-                found_one = True
-            elif found_one: # if we have found something previously, there is no need to check positions after this non-match, because they are sorted
-                break
-            elif index > start_index + 1 and not found_one: # if we haven't found anything, there is no need to check positions after start_index + 1, because they are sorted
-                break
-    
-    def matchSpan(span, start_index, max_index, include_beginning):
-        """Return the indexes that match the span, as well as the first index that was found and the last index that was found."""
-        matches = list(relevance(span, start_index, max_index, include_beginning))
-        if len(matches) > 0:
-            start_index = matches[0]
-            max_index = matches[-1]
+    def getMatches(node, position_indexes, tag_positions, final_matches):
+        """Check the node and it's children for all matches with the given positions. The spans inside a node are the gaps between it's child elements (including it's own open and close tags), which belong to the node itself, and the child elements."""
+        open_pos, close_pos = getNodePosition(view, node, tag_positions)
+        spans = getChildSpans(node, tag_positions)
+        starts, ends, indexes, has_children = spans[0:4]
         
-        return (matches, start_index, max_index)
-    
-    def getMatches(node, next_match_index, max_index, final_matches):
-        """Check the node and it's children for all matches within the specified range."""
-        spans = getNodePositions(view, node)
+        def getSpan(span_index):
+            child_index = span_index // 2
+            if span_index % 2 == 1:
+                return (starts[child_index], ends[child_index])
+            gap_start = open_pos.begin() if child_index == 0 else ends[child_index - 1]
+            gap_end = close_pos.end() if child_index == len(starts) else starts[child_index]
+            return (gap_start, gap_end)
         
-        found_match_at_last_expected_position_in_node = False
-        for span_node, pos_start, pos_end, is_final in spans:
-            matches, first_match_index, last_match_index = matchSpan(sublime.Region(pos_start, pos_end), next_match_index, max_index, span_node == node)
-            
-            if len(matches) > 0: # if matches were found
-                if last_match_index == max_index: # if the last index that matched is the maximum index that could match inside this node
-                    found_match_at_last_expected_position_in_node = True # it could be the last match inside this node
-                if is_final:
-                    final_matches.append((span_node, matches, pos_start, pos_end, span_node == node))
-                    next_match_index = last_match_index # the next index to search is the last index that matched
-                else:
-                    next_match_index = getMatches(span_node, first_match_index, last_match_index, final_matches) # the next index to search is the last index that matched
-            elif found_match_at_last_expected_position_in_node: # no match this time. If we have previously found the match at the last expected position within this node, then it was the last match in the node
-                break # stop looking for further matches
+        # span 2 * n is the gap before child n, and span 2 * n + 1 is child n
+        span_matches = {}
+        for position_index in position_indexes:
+            position = positions[position_index]
+            first_child = bisect.bisect_left(ends, position.begin()) # children that end before the position can't match it
+            last_child = bisect.bisect_right(starts, position.end()) # nor can children that start after it
+            for span_index in range(first_child * 2, last_child * 2 + 1):
+                span_start, span_end = getSpan(span_index)
+                if regionIntersects(sublime.Region(span_start, span_end), position, span_index % 2 == 0):
+                    span_matches.setdefault(span_index, []).append(position_index)
         
-        return next_match_index
+        for span_index in sorted(span_matches.keys()):
+            matches = span_matches[span_index]
+            span_start, span_end = getSpan(span_index)
+            if span_index % 2 == 0:
+                final_matches.append((node, matches, span_start, span_end, True))
+            else:
+                child_index = span_index // 2
+                child = getChildAt(node, spans, indexes[child_index])
+                if has_children[child_index]:
+                    getMatches(child, matches, tag_positions, final_matches)
+                else:
+                    final_matches.append((child, matches, span_start, span_end, False))
     
     matches = []
-    start_match_index = 0
     for root in roots:
         if root is not None:
-            last_match_index = len(positions) - 1
+            tag_positions = getTagPositions(root)
+            open_pos, close_pos = getNodePosition(view, root, tag_positions)
+            root_span = open_pos.cover(close_pos)
+            root_matches = [index for index, position in enumerate(positions) if regionIntersects(root_span, position, True)]
             
-            open_pos, close_pos = getNodePosition(view, root)
-            root_matches, start_match_index, last_match_index = matchSpan(open_pos.cover(close_pos), start_match_index, last_match_index, True)
-            get_matches_in_tree = len(root_matches) > 0 # determine if it is worth checking this tree
-                
-            if get_matches_in_tree: # skip the tree if it doesn't participate in the match (saves iterating through all children of root element unnecessarily)
-                start_match_index = getMatches(root, start_match_index, last_match_index, matches)
+            if len(root_matches) > 0: # skip the tree if it doesn't participate in the match (saves iterating through all children of root element unnecessarily)
+                getMatches(root, root_matches, tag_positions, matches)
     
     return matches
 
@@ -117,14 +168,31 @@ def get_nodes_from_document(nodes):
         yield node
 
 def get_regions_of_nodes(view, nodes, element_position_type, attribute_position_type):
-    global TAG_NAME_END_POS
     global RE_TAG_ATTRIBUTES
     
-    def ensureTagNameEndPosIsSet(node, open_pos):
-        try:
-            pos = node.tag_name_end_pos
-        except AttributeError:
-            node.tag_name_end_pos = open_pos.begin() + RE_TAG_NAME_END_POS.search(view.substr(open_pos)).start()
+    read = [0, '', OPEN_TAG_MIN_READ_AHEAD] # the position and text last read from the view, and how far past the region to read next time. Nodes are usually in document order, so reading ahead means the open tags of the following nodes don't need to be read separately
+    def getText(region):
+        """Return the text that was read from the view, and its position, including the given region."""
+        text_begin, text, read_ahead = read
+        if region.begin() < text_begin or region.end() > text_begin + len(text):
+            if text_begin <= region.begin() < text_begin + len(text) + read_ahead: # the nodes are close together, so read further ahead each time
+                read_ahead = min(read_ahead * 2, OPEN_TAG_READ_AHEAD)
+            else: # reading far ahead would mostly read the text between the nodes
+                read_ahead = OPEN_TAG_MIN_READ_AHEAD
+            text_begin = region.begin()
+            text = view.substr(sublime.Region(text_begin, max(region.end(), min(region.end() + read_ahead, view.size()))))
+            read[0:3] = [text_begin, text, read_ahead]
+        return (text_begin, text)
+    
+    def getTagNameEndPos(node, open_pos):
+        tag_positions = getTagPositions(node)
+        node_id = tag_positions.get_id(node)
+        pos = tag_positions.tag_name_ends[node_id]
+        if pos == -1: # the document was parsed before tag name ends were recorded
+            text_begin, text = getText(open_pos)
+            pos = text_begin + RE_TAG_NAME_END_POS.search(text, open_pos.begin() - text_begin).start()
+            tag_positions.tag_name_ends[node_id] = pos
+        return pos
     
     for node in nodes:
         attr_name = None
@@ -168,20 +236,20 @@ def get_regions_of_nodes(view, nodes, element_position_type, attribute_position_
             
             if element_position_type in ('open', 'close', 'names', 'open_attributes'):
                 # select only the tag name with the prefix
-                ensureTagNameEndPosIsSet(node, open_pos)
+                tag_name_end_pos = getTagNameEndPos(node, open_pos)
                 
                 if element_position_type == 'open_attributes':
                     chars_before_end = len('>')
                     if node.is_self_closing():
                         chars_before_end += len('/')
-                    yield sublime.Region(node.tag_name_end_pos, open_pos.end() - chars_before_end)
+                    yield sublime.Region(tag_name_end_pos, open_pos.end() - chars_before_end)
                 else:
                     chars_before_tag = len('<')
                     if element_position_type in ('open', 'names') or node.is_self_closing():
-                        yield sublime.Region(open_pos.begin() + chars_before_tag, node.tag_name_end_pos)
+                        yield sublime.Region(open_pos.begin() + chars_before_tag, tag_name_end_pos)
                     if element_position_type in ('close', 'names') and not node.is_self_closing():
                         chars_before_tag += len('/')
-                        yield sublime.Region(close_pos.begin() + chars_before_tag, close_pos.begin() + len('/') + (node.tag_name_end_pos - open_pos.begin()))
+                        yield sublime.Region(close_pos.begin() + chars_before_tag, close_pos.begin() + len('/') + (tag_name_end_pos - open_pos.begin()))
             elif element_position_type == 'content':
                 if node.is_self_closing():
                     yield sublime.Region(open_pos.end(), open_pos.end())
@@ -194,11 +262,11 @@ def get_regions_of_nodes(view, nodes, element_position_type, attribute_position_
             # position type 'content' <element attr1="|test|"></element> "Goto attribute value in open tag"
             # position type 'entire' <element |attr1="test"|></element> "Goto attribute declaration in open tag"
             
-            ensureTagNameEndPosIsSet(node, open_pos)
-            attrs = view.substr(sublime.Region(node.tag_name_end_pos, open_pos.end()))
+            tag_name_end_pos = getTagNameEndPos(node, open_pos)
+            text_begin, text = getText(open_pos)
             q = etree.QName(attr_name)
             
-            for match in RE_TAG_ATTRIBUTES.finditer(attrs):
+            for match in RE_TAG_ATTRIBUTES.finditer(text, tag_name_end_pos - text_begin, open_pos.end() - text_begin):
                 is_this = False
                 prefixed_name = match.group(2).split(':')
                 if len(prefixed_name) == 2 and prefixed_name[0] != 'xmlns':
@@ -214,7 +282,7 @@ def get_regions_of_nodes(view, nodes, element_position_type, attribute_position_
                         group = (3, 4)
                     
                     group = next(g for g in group if match.group(g) is not None) # find first value match group (i.e. if double quotes, group 3, if single quotes, group 4)
-                    yield sublime.Region(node.tag_name_end_pos + match.start(group), node.tag_name_end_pos + match.end(group))
+                    yield sublime.Region(text_begin + match.start(group), text_begin + match.end(group))
                     break
 
 def move_cursors_to_nodes(view, nodes, element_position_type, attribute_position_type):
@@ -233,9 +301,14 @@ def move_cursors_to_nodes(view, nodes, element_position_type, attribute_position
     return (len(nodes), total_results)
 
 def getElementXMLPreview(view, node, maxlen):
-    """Generate the xml string for the given node, up to the specified number of characters."""
+    """Generate the xml string for the given node, up to the specified number of characters. Only the start of the element is read from the view, so that previews of large elements are as quick as those of small ones."""
     open_pos, close_pos = getNodePosition(view, node)
-    preview = view.substr(sublime.Region(open_pos.begin(), close_pos.end()))
+    end = close_pos.end()
+    if maxlen >= 0:
+        end = min(end, open_pos.begin() + maxlen + 1) # the element starts with a '<', so there is no leading whitespace to trim and this is as much as collapseWhitespace looks at
+    preview = view.substr(sublime.Region(open_pos.begin(), end))
+    if end < close_pos.end():
+        preview += '>' # stands in for the rest of the element, which ends with a non whitespace character, so that the preview is truncated in the same way as if all of it had been read
     return collapseWhitespace(preview, maxlen)
 
 def parse_xpath_query_for_completions(view, completion_position):
@@ -356,6 +429,24 @@ def chunks(start, end, chunk_size): # inspired by http://stackoverflow.com/a/188
     """Return a generator that will split the range into chunks of the specified size."""
     return ((i, min(i + chunk_size, end)) for i in range(start, end, chunk_size))
 
+def chunk_size_for_region(region, chunk_size = 0):
+    """Return how many characters to read from the view at a time for the region. If the given chunk size isn't positive, choose one based on the size of the region: small regions are read all at once, larger ones in about a hundred chunks so that progress can be shown and parsing can be cancelled part way through, but never more than a million characters at a time."""
+    if chunk_size > 0:
+        return chunk_size
+    return min(max(region.size() // 100, 65536), 1048576)
+
 def region_chunks(view, region, chunk_size):
     """Return a generator that will split the region into chunks of the specified size."""
     return (view.substr(sublime.Region(begin, end)) for begin, end in chunks(region.begin(), region.end(), chunk_size))
+
+def file_chunks(file_name, chunk_size):
+    """Return a generator that will split the memory mapped contents of the file into chunks of bytes of the specified size, skipping any UTF-8 byte order mark."""
+    with open(file_name, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0: # an empty file can't be mapped
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            start = 0
+            if data[0:len(codecs.BOM_UTF8)] == codecs.BOM_UTF8:
+                start = len(codecs.BOM_UTF8)
+            for begin, end in chunks(start, len(data), chunk_size):
+                yield data[begin:end]
@@ -1,16 +1,21 @@
 import sublime
 import sublime_plugin
+import os
+import tempfile
 import traceback
 import random
+import time
+import types
 
 from .lxml_parser import *
-from .sublime_lxml import parse_xpath_query_for_completions
+from .sublime_lxml import parse_xpath_query_for_completions, file_chunks
+from .xpath import ensureTreeCacheIsCurrent, recordTextChanges, pending_edits, pending_edits_lock
 
 class RunXpathTestsCommand(sublime_plugin.TextCommand): # sublime.active_window().active_view().run_command('run_xpath_tests')
     def run(self, edit):
         try:
             xml = sublime.load_resource(sublime.find_resources('example_xml_ns.xml')[0])
-            tree, all_elements = lxml_etree_parse_xml_string_with_location(xml)
+            tree = lxml_etree_parse_xml_string_with_location(xml)
             
             def sublime_lxml_completion_tests():
                 def test_xpath_completion(xpath, expectation):
@@ -172,8 +177,191 @@ class RunXpathTestsCommand(sublime_plugin.TextCommand): # sublime.active_window(
                 view.window().run_command('close')
                 
             
+            def lxml_parser_location_tests():
+                markup = '<?xml version="1.0"?><!DOCTYPE root [<!-- in subset -->]><!--a > b--><root a="x>y"><![CDATA[<not> ]] >]]><?pi ? > ?><self_closing attr="/"/><child\n\t/></root>'
+                expected = ['<!-- in subset -->', '<!--a > b-->', '<root a="x>y">', '<?pi ? > ?>', '<self_closing attr="/"/>', '<child\n\t/>']
+                
+                def source(node, position_type):
+                    start, end = getNodeTagRange(node, position_type)
+                    return markup[start:end]
+                
+                for chunk_size in (1, 3, len(markup)):
+                    tree = lxml_etree_parse_xml_string_with_location(markup[i:i + chunk_size] for i in range(0, len(markup), chunk_size))
+                    root = tree.getroot()
+                    nodes = list(reversed(list(root.itersiblings(preceding=True)))) + list(root.iter())
+                    actual = [source(node, 'open') for node in nodes]
+                    assert actual == expected, 'chunk size: ' + str(chunk_size) + '\nexpected: ' + repr(expected) + '\nactual: ' + repr(actual)
+                    assert source(root, 'close') == '</root>'
+                    assert root[1].is_self_closing() and not root.is_self_closing()
+                    nodes = actual = None # the positions must still be found when the proxies are recreated
+                    assert [source(node, 'open') for node in root.iter()] == expected[2:]
+                
+                # markup in the internal subset that contains a > and is split between chunks
+                markup = '<!DOCTYPE r [<!-- c > --><?pi > ?><!ENTITY e "a > b">]><r a="1"><c/></r>'
+                expected = ['<!-- c > -->', '<?pi > ?>', '<r a="1">', '<c/>']
+                for chunk_size in range(1, 65):
+                    root = lxml_etree_parse_xml_string_with_location(markup[i:i + chunk_size] for i in range(0, len(markup), chunk_size)).getroot()
+                    actual = [source(node, 'open') for node in list(reversed(list(root.itersiblings(preceding=True)))) + list(root.iter())]
+                    assert actual == expected, 'chunk size: ' + str(chunk_size) + '\nexpected: ' + repr(expected) + '\nactual: ' + repr(actual)
+                
+                # a UTF-8 file with CR LF line endings is parsed as bytes, whose positions must be translated to the characters shown in the view
+                markup = '<!-- é€ -->\n<root a="é">\n\t<ü>€𝄞<!-- 𝄞 --></ü>\n\t<![CDATA[ € ]]><?pi € ?>\n\t<child b="𝄞é"\n\t/>\n</root>\n'
+                def ranges(root):
+                    nodes = list(reversed(list(root.itersiblings(preceding=True)))) + list(root.iter())
+                    return [(getNodeTagRange(node, 'open'), getNodeTagRange(node, 'close') if isinstance(node.tag, str) else None) for node in nodes]
+                
+                expected = ranges(lxml_etree_parse_xml_string_with_location(markup).getroot())
+                with tempfile.NamedTemporaryFile('wb', suffix='.xml', delete=False) as f:
+                    f.write(markup.replace('\n', '\r\n').encode('UTF-8'))
+                try:
+                    for chunk_size in range(1, 9): # chunk boundaries fall between the bytes of the 2, 3 and 4 byte characters, and between CR and LF
+                        actual = ranges(lxml_etree_parse_xml_string_with_location(file_chunks(f.name, chunk_size)).getroot())
+                        assert actual == expected, 'chunk size: ' + str(chunk_size) + '\nexpected: ' + repr(expected) + '\nactual: ' + repr(actual)
+                finally:
+                    os.remove(f.name)
+            
+            def tag_ranges(root):
+                nodes = list(reversed(list(root.itersiblings(preceding=True)))) + list(root.iter()) + list(root.itersiblings())
+                return [(node.tag, getNodeTagRange(node, 'open'), getNodeTagRange(node, 'close')) for node in nodes]
+            
+            def incremental_parsing_tests():
+                self.view.window().run_command('new_file')
+                view = self.view.window().active_view()
+                
+                view.insert(edit, 0, xml)
+                view.set_syntax_file('xml.sublime-syntax')
+                view.set_scratch(True) # so we don't get a message asking to save when we close the view
+                
+                def replace(begin, end, text):
+                    count = view.change_count()
+                    view.replace(edit, sublime.Region(begin, end), text)
+                    with pending_edits_lock: # the change listener may not have been told about the change yet
+                        pending_edits[view.id()] = (count, None)
+                    recordTextChanges(view, [types.SimpleNamespace(a=types.SimpleNamespace(pt=begin), b=types.SimpleNamespace(pt=end), str=text)])
+                    
+                    root = ensureTreeCacheIsCurrent(view)[0]
+                    assert root is original_root, 'the element containing ' + repr(text) + ' was not parsed again on its own'
+                    expected = tag_ranges(lxml_etree_parse_xml_string_with_location(view.substr(sublime.Region(0, view.size()))).getroot())
+                    actual = tag_ranges(root)
+                    assert actual == expected, 'after replacing ' + repr((begin, end)) + ' with ' + repr(text) + '\ndifferences: ' + repr([pair for pair in zip(expected, actual) if pair[0] != pair[1]][:3])
+                
+                def find(text, offset = 0):
+                    return view.find(text, 0, sublime.LITERAL).begin() + offset
+                
+                original_root = ensureTreeCacheIsCurrent(view)[0]
+                replace(find('sample text', 6), find('sample text', 6), 'd') # text added to a child element
+                replace(find('sampled '), find('sampled ', 8), '') # text removed from a child element
+                replace(find('text<more', 2), find('text<more', 2), '<new>inserted <child/></new>') # an element added to a child element
+                replace(find('inserted', 8), find('inserted', 8), 'x') # inside the element inserted earlier
+                replace(find('<!-- second', 4), find('<!-- second', 4), '\n') # inside a comment
+                
+                view.window().run_command('close')
+            
+            def xpath_planner_tests():
+                markup = '<root xmlns:a="uri_a" xmlns:b="uri_b" b:x="1"><a:item id="1">one</a:item><item a:id="2"/><item xmlns="uri_d" id="3"><a:item/><item/></item><!-- <item/> --></root>'
+                tree = lxml_etree_parse_xml_string_with_location(markup)
+                nsmap = { 'a': 'uri_a', 'b': 'uri_b', 'd': 'uri_d', 'unused': 'uri_unused' }
+                
+                queries = ['//.', '//..', '//*', '//item', '//a:item', '//d:item', '//unused:item', '//missing', '//item[@id]', '//item[@a:id]', "//item[@a:id = '2']", "//a:item[@id = '1']", '//a:item[@id="2"]', '//d:item[@id]', '//d:item[@b:x]', '//d:item[@missing]', '//@id', '//@a:id', '//@b:x', '//@missing', '//@unused:id']
+                planned = []
+                for query in queries:
+                    expected = tree.xpath(query, namespaces=nsmap)
+                    plan = plan_xpath_query(query, tree, nsmap)
+                    if plan is not None:
+                        planned.append(query)
+                        results, count = plan
+                        actual = list(results)
+                        assert actual == expected, 'query: ' + query + '\nexpected: ' + repr(expected) + '\nactual: ' + repr(actual)
+                        assert count is None or count == len(expected), 'query: ' + query + '\nexpected count: ' + str(len(expected)) + '\nactual: ' + str(count)
+                for query in ('//*', '//a:item', '//missing', '//unused:item', '//d:item[@missing]', '//@missing', '//@unused:id'):
+                    assert query in planned, 'query: ' + query + ' was not answered from the name index'
+                for query in ('//.', '//..', '//-x', '//1x', '//@-x', '//a:.x'): # not names, so they must be left to the xpath engine
+                    assert query not in planned and plan_xpath_query(query, tree, nsmap) is None, 'query: ' + query + ' was answered from the name index'
+                
+                name_index = NameIndex.for_tree(tree.getroot())
+                for uri in (None, 'uri_a', 'uri_b', 'uri_d', 'uri_unused'):
+                    for localname in ('root', 'item', 'id', 'x', 'missing'):
+                        variables = { 'uri': uri or '', 'localname': localname }
+                        assert name_index.count_elements(uri, localname) == int(tree.xpath('count(//*[namespace-uri() = $uri and local-name() = $localname])', **variables)), 'elements: ' + repr((uri, localname))
+                        assert name_index.has_attribute(uri, localname) == tree.xpath('boolean(//@*[namespace-uri() = $uri and local-name() = $localname])', **variables), 'attributes: ' + repr((uri, localname))
+            
+            def xpath_extension_tests():
+                root = etree.fromstring('<r><i p="3" c="a">x1</i><i p="1.5" c="b"/><i p=" 10 " c="a"/><i p="2" c="c"/><d>2024-03-05T10:20:30.5Z</d><d>2023-01-02</d><t>10:20:30</t></r>')
+                expectations = [
+                    ('avg(//@p)', 4.125),
+                    ('min(//@p)', 1.5),
+                    ('max(//@p)', 10),
+                    ('count(max(//nothing))', 0),
+                    ('abs(//i[2]/@p - 3)', 1.5),
+                    ('distinct-values(//@c)', ['a', 'b', 'c']),
+                    ('index-of(//@c, "a")', ['1', '3']),
+                    ('index-of(//@p, 2)', ['4']),
+                    ('subsequence(//@c, 2)', ['b', 'a', 'c']),
+                    ('subsequence(//@c, 1.5, 2)', ['b', 'a']),
+                    ('insert-before(//@c, 2, "z")', ['a', 'z', 'b', 'a', 'c']),
+                    ('insert-before(//@c, 99, //i[1]/@p)', ['a', 'b', 'a', 'c', '3']),
+                    ('remove(//@c, 1)', ['b', 'a', 'c']),
+                    ('reverse(//@p)', ['2', ' 10 ', '1.5', '3']),
+                    ('subsequence(reverse(//@p), 1, 1)', ['2']),
+                    ('string(reverse(//i))', ''), # the last element has no text
+                    ('exists(//i)', True),
+                    ('empty(//nothing)', True),
+                    ('exists("")', True),
+                    ('year-from-dateTime(//d[1])', 2024),
+                    ('month-from-dateTime(//d[1])', 3),
+                    ('seconds-from-dateTime(//d[1])', 30.5),
+                    ('day-from-date(//d[2])', 2),
+                    ('count(hours-from-dateTime(//d[2]))', 0),
+                    ('minutes-from-time(//t)', 20),
+                    ('tokenize("a, b,c", ",\\s*")', ['a', 'b', 'c']),
+                    ('matches(//i[1], "^x\\d$")', True),
+                    ('replace("abc", "(b)", "[$1]")', 'a[b]c'),
+                    ('upper-case(//@c[1])', ['A', 'B', 'A', 'C']),
+                ]
+                for query, expected in expectations:
+                    actual = root.xpath(query)
+                    assert actual == expected, 'query: ' + query + '\nexpected: ' + repr(expected) + '\nactual: ' + repr(actual)
+            
+            def text_change_listener_tests():
+                # the change listener is only told about changes once the command that made them has finished, so the edit is made, and the trees are checked, from timeouts - and the outcome is reported separately
+                self.view.window().run_command('new_file')
+                view = self.view.window().active_view()
+                
+                view.insert(edit, 0, xml)
+                view.set_syntax_file('xml.sublime-syntax')
+                view.set_scratch(True) # so we don't get a message asking to save when we close the view
+                original_root = ensureTreeCacheIsCurrent(view)[0]
+                
+                def edit_view():
+                    view.sel().clear()
+                    view.sel().add(sublime.Region(view.find('sample text', 0, sublime.LITERAL).begin() + 6))
+                    view.run_command('insert', { 'characters': 'd' }) # text added to a child element
+                    sublime.set_timeout(check_trees, 100)
+                
+                def check_trees():
+                    try:
+                        root = ensureTreeCacheIsCurrent(view)[0]
+                        assert root is original_root, 'the change listener did not record the edit, so the whole document was parsed again'
+                        expected = tag_ranges(lxml_etree_parse_xml_string_with_location(view.substr(sublime.Region(0, view.size()))).getroot())
+                        assert tag_ranges(root) == expected, 'the tag positions differ from a full parse after the edit'
+                        print('XPath text change listener tests passed')
+                    except Exception as e:
+                        print('XPath text change listener tests failed')
+                        print(repr(e))
+                        traceback.print_tb(e.__traceback__)
+                    finally:
+                        view.close()
+                
+                sublime.set_timeout(edit_view, 0)
+            
+            lxml_parser_location_tests()
+            xpath_extension_tests()
+            xpath_planner_tests()
+            incremental_parsing_tests()
             sublime_lxml_completion_tests()
             sublime_lxml_goto_node_tests()
+            if hasattr(sublime_plugin, 'TextChangeListener'): # Sublime Text 4
+                text_change_listener_tests()
             
             # TODO: check the results of an xpath query
             #        e.g. `count(//@*)`
@@ -184,3 +372,35 @@ class RunXpathTestsCommand(sublime_plugin.TextCommand): # sublime.active_window(
             print(repr(e))
             traceback.print_tb(e.__traceback__)
             
+
+class RunXpathBenchmarksCommand(sublime_plugin.TextCommand): # sublime.active_window().active_view().run_command('run_xpath_benchmarks')
+    """Time the XPath 2.0 aggregate and sequence functions against their XPath 1.0 equivalents, on documents of increasing size, and print the results to the console."""
+    def run(self, edit, sizes = (1000, 2000, 4000), repeat = 3):
+        comparisons = [
+            ('distinct-values(//item/@category)', '//item[not(@category = preceding-sibling::item/@category)]/@category'),
+            ('max(//item/@price)', 'number((//item[not(@price < //item/@price)]/@price)[1])'),
+            ('min(//item/@price)', 'number((//item[not(@price > //item/@price)]/@price)[1])'),
+            ('avg(//item/@price)', 'sum(//item/@price) div count(//item/@price)'),
+            ('index-of(//item/@category, "c7")', '//item[@category = "c7"]/@category'),
+        ]
+        
+        def best_time(root, query):
+            best = None
+            for attempt in range(repeat):
+                start = time.perf_counter()
+                result = root.xpath(query)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            return (result, best)
+        
+        for size in sizes:
+            items = ''.join('<item category="c{0}" price="{1}"/>'.format(random.randint(0, 49), random.randint(1, 100000) / 100) for index in range(size))
+            root = etree.fromstring('<items>' + items + '</items>')
+            for extension_query, equivalent_query in comparisons:
+                extension_result, extension_time = best_time(root, extension_query)
+                equivalent_result, equivalent_time = best_time(root, equivalent_query)
+                if isinstance(extension_result, list):
+                    same = len(extension_result) == len(equivalent_result)
+                else:
+                    same = abs(extension_result - equivalent_result) < 1e-6
+                print('XPath: benchmark', size, 'items:', extension_query, '{0:.1f}ms'.format(extension_time * 1000), 'vs', equivalent_query, '{0:.1f}ms'.format(equivalent_time * 1000), '' if same else '(different results!)')
@@ -4,15 +4,39 @@ import os
 from lxml import etree
 from xml.sax import SAXParseException
 import re
+import collections
+import datetime
+import functools
+import math
+import threading
+import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor
 from .lxml_parser import *
+from .lxml_parse_cache import load_parse_cache, save_parse_cache, evict_parse_cache, snapshot_tag_positions
 from .sublime_lxml import *
 from .sublime_input_quickpanel import QuickPanelFromInputCommand
 import traceback
 
 change_counters = {}
 xml_roots = {}
-xml_elements = {}
 previous_first_selection = {}
+sgml_regions = {}
+RECENT_FIRST_SELECTIONS = 32 # how many of the most recently visited nodes to remember the xpath regions of, so that moving back and forth between them i.e. through a list of siblings doesn't need to look the node up again
+pending_edits = {}
+query_results = {}
+query_results_lock = threading.Lock()
+running_queries = {}
+query_evaluations = {} # the query evaluation running for each view, and the one waiting to run after it
+query_evaluations_lock = threading.Lock()
+background_query_evaluations = {} # the evaluation nobody is waiting for, i.e. counting all the results of a query, running for each view
+query_costs = {}
+QUERY_COST_WEIGHT = 0.3 # how much the most recent query counts towards the moving average of how long queries take
+pending_edits_lock = threading.Lock()
+parse_jobs = {}
+parse_jobs_lock = threading.Lock()
+trees_lock = threading.RLock()
+region_parse_pool = None
 settings = None
 parse_error = 'XPath - error parsing XML at '
 html_cleaning_answer = {}
@@ -21,18 +45,34 @@ def settingsChanged():
     """Clear change counters and cached xpath regions for all views, and reparse xml regions for the current view."""
     global change_counters
     global xml_roots
-    global xml_elements
     global previous_first_selection
-    change_counters.clear()
-    xml_roots.clear()
-    xml_elements.clear()
-    previous_first_selection.clear()
+    global sgml_regions
+    global pending_edits
+    for view_id in list(parse_jobs.keys()):
+        cancelParse(view_id)
+    with trees_lock:
+        change_counters.clear()
+        xml_roots.clear()
+        previous_first_selection.clear()
+        sgml_regions.clear()
+    with pending_edits_lock:
+        pending_edits.clear()
+    with query_results_lock:
+        query_results.clear()
     updateStatusToCurrentXPathIfSGML(sublime.active_window().active_view())
 
 def getSGMLRegions(view):
-    """Find all xml and html scopes in the specified view."""
+    """Find all xml and html scopes in the specified view. They are remembered until the view is modified or its syntax changes, as commands check for them every time the menus are shown."""
     global settings
-    return view.find_by_selector(settings.get('sgml_selector'))
+    global sgml_regions
+    key = (view.change_count(), view.settings().get('syntax'))
+    cached = sgml_regions.get(view.id(), None)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    regions = view.find_by_selector(settings.get('sgml_selector'))
+    if view.change_count() == key[0]: # the view wasn't modified while the regions were being found
+        sgml_regions[view.id()] = (key, regions)
+    return regions
 
 def containsSGML(view):
     """Return True if the view contains XML or HTML syntax."""
@@ -40,83 +80,403 @@ def containsSGML(view):
 
 def getSGMLRegionsContainingCursors(view):
     """Find the SGML region(s) that the cursor(s) are in for the specified view."""
-    cursors = [cursor for cursor in view.sel()] # can't use `view.sel()[:]` because it gives an error `TypeError: an integer is required`
     regions = getSGMLRegions(view)
-    for region_index, region in enumerate(regions):
-        cursors_to_remove = []
-        for cursor in cursors:
-            if region.contains(cursor):
-                yield (region, region_index, cursor)
-                cursors_to_remove.append(cursor)
-            elif region.begin() > cursor.end(): # cursor before this region
-                cursors_to_remove.append(cursor)
-            elif cursor.begin() > region.end(): # found all cursors in this region
-                break
-        if region_index < len(regions) - 1: # no point removing cursors from those left to find if no regions left to search through
-            for cursor in cursors_to_remove:
-                cursors.remove(cursor)
-            if len(cursors) == 0:
-                break
+    if len(regions) == 0:
+        return
+    region_index = 0
+    region = regions[0]
+    region_begin, region_end = region.begin(), region.end()
+    for cursor in view.sel(): # both the cursors and the regions are sorted and don't overlap, so they can be walked through together
+        cursor_end = cursor.end()
+        while region_end < cursor_end: # this and the following cursors are after this region
+            region_index += 1
+            if region_index == len(regions):
+                return
+            region = regions[region_index]
+            region_begin, region_end = region.begin(), region.end()
+        if cursor.begin() >= region_begin:
+            yield (region, region_index, cursor)
 
 def isCursorInsideSGML(view):
     """Return True if at least one cursor is within XML or HTML syntax."""
     return next(getSGMLRegionsContainingCursors(view), None) is not None
 
-def buildTreesForView(view):
-    """Create an xml tree for each XML region in the specified view."""
+def buildTreesForView(view, job = None):
+    """Create an xml tree for each XML region in the specified view, parsing the regions in parallel."""
+    regions = getSGMLRegions(view)
+    if job is not None:
+        job.total = sum(region.size() for region in regions)
+    if len(regions) > 1:
+        results = list(getRegionParsePool().map(lambda region: buildTreeForViewRegion(view, region, job), regions)) # the results are in region order, regardless of which parse finishes first
+    else:
+        results = [buildTreeForViewRegion(view, region, job) for region in regions]
+    
     trees = []
-    for region in getSGMLRegions(view):
-        trees.append(buildTreeForViewRegion(view, region))
+    for region, (tree, error) in zip(regions, results):
+        if error is not None:
+            showParseError(view, region, error)
+        trees.append(tree)
     return trees
 
-def buildTreeForViewRegion(view, region_scope):
-    """Create an xml tree for the XML in the specified view region."""
-    tree = None
-    all_elements = None
+def getRegionParsePool():
+    """Return the thread pool used to parse the XML regions of a view concurrently."""
+    global region_parse_pool
+    if region_parse_pool is None:
+        region_parse_pool = ThreadPoolExecutor(max_workers=max(2, multiprocessing.cpu_count()))
+    return region_parse_pool
+
+def buildTreeForViewRegion(view, region_scope, job = None, from_file = None):
+    """Create an xml tree for the XML in the specified view region. Return the tree, or the syntax error if the XML isn't valid."""
+    global settings
+    if from_file is None:
+        from_file = canParseFromFile(view, region_scope)
+    chunk_size = chunk_size_for_region(region_scope, settings.get('parse_chunk_size', 0))
+    if from_file:
+        chunks = file_chunks(view.file_name(), chunk_size)
+    else:
+        chunks = region_chunks(view, region_scope, chunk_size)
+    timings = None
+    if settings.get('log_parse_timings', False):
+        timings = { 'chunks': 0, 'read': 0.0, 'start': time.perf_counter() }
+        chunks = timeChunkReads(chunks, timings)
     change_count = view.change_count()
     stop = lambda: change_count < view.change_count() # stop parsing if the document is modified
     if view.is_read_only():
         stop = None # no need to check for modifications if the view is read only
+    if job is not None:
+        chunks = job.reportProgress(chunks)
+        stop = job.isStale
     try:
-        tree, all_elements = lxml_etree_parse_xml_string_with_location(region_chunks(view, region_scope, 8096), region_scope.begin(), stop)
-    except etree.XMLSyntaxError as e:
-        global settings
-        show_parse_errors = settings.get('show_xml_parser_errors', True)
-        if show_parse_errors:
-            global parse_error
-            offset = view.rowcol(region_scope.begin())
-            log_entry = e.error_log[0]
+        tree = lxml_etree_parse_xml_string_with_location(chunks, region_scope.begin(), stop)
+    except Exception as e: # not only syntax errors, i.e. lxml rejects some namespace URIs with a ValueError
+        if stop is not None and stop(): # a parse that was stopped early is incomplete rather than invalid
+            return (None, None)
+        return (None, e)
+    finally:
+        if timings is not None:
+            print('XPath: parsed region', region_scope.begin(), '-', region_scope.end(), 'of', region_scope.size(), 'characters', 'from the file' if from_file else 'from the view', 'in', timings['chunks'], 'chunks of', chunk_size, 'characters:', int((time.perf_counter() - timings['start']) * 1000), 'ms, of which', int(timings['read'] * 1000), 'ms was reading')
+    
+    if from_file and not treeMatchesView(view, tree):
+        print('XPath: the contents of "' + view.file_name() + '" don\'t match the view, parsing the view instead')
+        return buildTreeForViewRegion(view, region_scope, job, False)
+    return (tree, None)
+
+def canParseFromFile(view, region_scope):
+    """Return True if the region can be parsed directly from the file on disk, because it covers the whole of a saved, unmodified UTF-8 file, so the file's contents are what the view shows."""
+    global settings
+    return settings.get('parse_from_file', True) and view.file_name() is not None and not view.is_dirty() and view.encoding() in ('UTF-8', 'UTF-8 with BOM') and region_scope.begin() == 0 and region_scope.end() == view.size() and os.path.isfile(view.file_name())
+
+def treeMatchesView(view, tree):
+    """Check that the open and close tags of the root element, as parsed from the file, are where the view has them."""
+    root = tree.getroot()
+    for position_type in ('open', 'close'):
+        tag = view.substr(getNodeTagRegion(view, root, position_type))
+        if not tag.startswith('<') or not tag.endswith('>'):
+            return False
+    return True
+
+def timeChunkReads(chunks, timings):
+    """Pass through the chunks, keeping count of them and of the time taken to read them."""
+    chunks = iter(chunks)
+    while True:
+        start = time.perf_counter()
+        chunk = next(chunks, None)
+        timings['read'] += time.perf_counter() - start
+        if chunk is None:
+            return
+        timings['chunks'] += 1
+        yield chunk
+
+def showParseError(view, region_scope, error):
+    """Show the syntax error found in the specified view region in the status bar, if the settings allow it."""
+    global settings
+    show_parse_errors = settings.get('show_xml_parser_errors', True)
+    if show_parse_errors:
+        global parse_error
+        offset = view.rowcol(region_scope.begin())
+        if getattr(error, 'error_log', None):
+            log_entry = error.error_log[0]
             text = 'line ' + str(log_entry.line + offset[0]) + ', column ' + str(log_entry.column + offset[1]) + ' - ' + log_entry.message
-            view.set_status('xpath_error', parse_error + text)
-    
-    return (tree, all_elements)
+        else: # the error wasn't reported by libxml2, so the location isn't known
+            text = 'line ' + str(offset[0] + 1) + ' - ' + str(error)
+        view.set_status('xpath_error', parse_error + text)
+
+class ParseJob:
+    """Parse the XML regions of a view, as they are at the given change count, in a background thread. The trees are only published if the view hasn't been modified in the meantime."""
+    def __init__(self, view, change_count):
+        self.view = view
+        self.change_count = change_count
+        self.cancelled = False
+        self.finished = threading.Event()
+        self.roots = None
+        self.error = None
+        self.total = 0
+        self.parsed = 0
+        self.percent = None
+        self._thread = None
+        self._lock = threading.Lock()
+    
+    def start(self):
+        """Start parsing, unless it has already started or the job was cancelled."""
+        with self._lock:
+            if self._thread is not None or self.cancelled:
+                return
+            self._thread = threading.Thread(target=self.run)
+            self._thread.daemon = True
+            self._thread.start()
+    
+    def isStale(self):
+        return self.cancelled or self.view.change_count() != self.change_count
+    
+    def reportProgress(self, chunks):
+        """Pass through the chunks being parsed, showing the percentage parsed so far in the status bar."""
+        for chunk in chunks:
+            yield chunk
+            with self._lock: # regions can be parsed concurrently
+                self.parsed += len(chunk)
+                percent = min(self.parsed * 100 // max(self.total, 1), 100) # when parsing from a file, the chunks are bytes rather than characters
+                if percent != self.percent and not self.isStale():
+                    self.percent = percent
+                    self.view.set_status('xpath', 'XML being parsed... ' + str(percent) + '%')
+    
+    def run(self):
+        view = self.view
+        cache_positions = None
+        try:
+            if self.isStale():
+                return
+            view.set_status('xpath', 'XML being parsed...')
+            view.erase_status('xpath_error')
+            
+            try:
+                cacheable_file = getCacheableFile(view)
+                trees = None
+                if cacheable_file is not None:
+                    trees = loadTreesFromParseCache(cacheable_file)
+                if trees is None:
+                    trees = buildTreesForView(view, self)
+                    if cacheable_file is not None and len(trees) == 1 and trees[0] is not None:
+                        cache_positions = snapshot_tag_positions(trees[0].getroot().tag_positions) # before the trees are published and can be modified
+            except Exception as e: # publish the failure like a parse error, rather than leave the trees unpublished and have the callers parse the same text again
+                self.error = e
+                print('XPath: unable to parse the XML:', repr(e))
+                traceback.print_exc()
+                trees = [None] * len(getSGMLRegions(view))
+            
+            roots = []
+            for tree in trees:
+                root = None
+                if tree is not None:
+                    root = tree.getroot()
+                roots.append(root)
+            
+            global change_counters
+            global xml_roots
+            global previous_first_selection
+            global pending_edits
+            with trees_lock, pending_edits_lock:
+                if not self.isStale(): # publish the trees all at once
+                    xml_roots[view.id()] = roots
+                    change_counters[view.id()] = self.change_count
+                    previous_first_selection[view.id()] = None
+                    pending_edits[view.id()] = (self.change_count, None) # start tracking edits made after this parse
+                    self.roots = roots
+            if self.roots is not None:
+                dropQueryResults(view.id())
+        finally:
+            with parse_jobs_lock:
+                if parse_jobs.get(view.id(), None) is self:
+                    del parse_jobs[view.id()]
+            self.finished.set()
+        
+        if self.roots is not None:
+            view.erase_status('xpath')
+            status_updates.request(view)
+            if cache_positions is not None:
+                saveTreesToParseCache(cacheable_file, self.roots[0].all_namespaces, cache_positions)
+
+def getParseCacheDir():
+    return os.path.join(sublime.cache_path(), 'XPath', 'ParseCache')
+
+def getCacheableFile(view):
+    """If the parse results for the view should be cached on disk, return the name and stat of the file it shows and the region to parse, otherwise None."""
+    global settings
+    if not settings.get('use_parse_cache', True) or view.file_name() is None or view.is_dirty():
+        return None
+    regions = getSGMLRegions(view)
+    if len(regions) != 1:
+        return None
+    try:
+        stat = os.stat(view.file_name())
+    except OSError:
+        return None
+    if stat.st_size < settings.get('parse_cache_min_file_size_mb', 10) * 1024 * 1024:
+        return None
+    return (view.file_name(), stat, regions[0])
+
+def loadTreesFromParseCache(cacheable_file):
+    """Return the trees for the view from the parse cache, or None if it doesn't have them."""
+    global settings
+    file_name, stat, region = cacheable_file
+    start = time.perf_counter()
+    try:
+        tree = load_parse_cache(getParseCacheDir(), file_name, (region.begin(), region.end()))
+    except (OSError, EOFError, ValueError, etree.XMLSyntaxError) as e:
+        print('XPath: unable to use the parse cache for "' + file_name + '": ' + repr(e))
+        return None
+    if tree is None:
+        return None
+    if settings.get('log_parse_timings', False):
+        print('XPath: loaded region', region.begin(), '-', region.end(), 'from the parse cache in', int((time.perf_counter() - start) * 1000), 'ms')
+    return [tree]
+
+def saveTreesToParseCache(cacheable_file, all_namespaces, positions):
+    """Save the positions and namespaces of a freshly parsed view to the parse cache, and remove old entries from it."""
+    global settings
+    file_name, stat, region = cacheable_file
+    try:
+        save_parse_cache(getParseCacheDir(), file_name, stat, (region.begin(), region.end()), all_namespaces, positions)
+        evict_parse_cache(getParseCacheDir(), settings.get('parse_cache_max_size_mb', 500) * 1024 * 1024, settings.get('parse_cache_max_age_days', 30) * 24 * 60 * 60)
+    except OSError as e:
+        print('XPath: unable to save the parse cache for "' + file_name + '": ' + repr(e))
+
+def scheduleParse(view, change_count, delay):
+    """Ensure that a parse of the view at the given change count is in progress or will start after the delay in milliseconds, cancelling any parse of an older version of the view. Return the job."""
+    global parse_jobs
+    with parse_jobs_lock:
+        job = parse_jobs.get(view.id(), None)
+        if job is None or job.change_count != change_count or job.cancelled:
+            if job is not None:
+                job.cancelled = True
+            job = ParseJob(view, change_count)
+            parse_jobs[view.id()] = job
+    
+    if delay <= 0:
+        job.start()
+    else: # if the view is modified again before the delay elapses, this job will be cancelled and replaced
+        sublime.set_timeout_async(job.start, delay)
+    return job
+
+def cancelParse(view_id):
+    global parse_jobs
+    with parse_jobs_lock:
+        job = parse_jobs.pop(view_id, None)
+        if job is not None:
+            job.cancelled = True
 
-def ensureTreeCacheIsCurrent(view):
-    """If the document has been modified since the xml was parsed, parse it again to recreate the trees."""
+def ensureTreeCacheIsCurrent(view, wait = True):
+    """If the document has been modified since the xml was parsed, parse it again to recreate the trees. If wait is False and the trees aren't current, return None instead of waiting for the parse to finish."""
     global change_counters
-    new_count = view.change_count()
-    old_count = change_counters.get(view.id(), None)
-    
     global xml_roots
-    global xml_elements
-    if old_count is None or new_count > old_count:
-        change_counters[view.id()] = new_count
-        view.set_status('xpath', 'XML being parsed...')
-        view.erase_status('xpath_error')
-        
-        xml_roots[view.id()] = []
-        xml_elements[view.id()] = []
-        for tree, all_elements in buildTreesForView(view):
-            root = None
-            if tree is not None:
-                root = tree.getroot()
-            xml_roots[view.id()].append(root)
-            xml_elements[view.id()].append(all_elements)
+    global previous_first_selection
+    while True:
+        new_count = view.change_count()
+        with trees_lock:
+            old_count = change_counters.get(view.id(), None)
+            if old_count is not None and new_count <= old_count:
+                return xml_roots[view.id()]
+            if old_count is not None and updateTreesIncrementally(view, new_count):
+                change_counters[view.id()] = new_count
+                previous_first_selection[view.id()] = None
+                dropQueryResults(view.id())
+                return xml_roots[view.id()]
         
-        view.erase_status('xpath')
-        global previous_first_selection
-        previous_first_selection[view.id()] = None
-    return xml_roots[view.id()]
+        delay = 0
+        if not wait and old_count is not None: # wait for a pause in the modifications before parsing the whole document again
+            delay = settings.get('parse_delay', 250)
+        job = scheduleParse(view, new_count, delay)
+        if not wait:
+            return None
+        job.finished.wait()
+        if job.roots is not None:
+            return job.roots
+        if not job.isStale(): # the job failed without publishing anything, so parsing the same text again wouldn't help
+            return [None] * len(getSGMLRegions(view))
+
+def mergeEdits(edit, begin, end, length):
+    """Given the extent of the previous edits (if any) as the begin and end positions before those edits were made and the difference in size, combine it with an edit that replaced the current text between begin and end with text of the given length."""
+    if edit is None:
+        return (begin, end, length - (end - begin))
+    
+    old_begin, old_end, delta = edit
+    if begin < old_begin: # the edit starts before the previously edited text
+        old_begin = begin
+    if end > old_end + delta: # the edit ends after the previously edited text, convert the position to what it was before the previous edits
+        old_end = end - delta
+    return (old_begin, old_end, delta + length - (end - begin))
+
+def recordTextChanges(view, changes):
+    """Keep track of the extent of the changes made to the view since it was last parsed, so that only the affected part of the tree needs to be parsed again."""
+    global pending_edits
+    with pending_edits_lock:
+        tracked = pending_edits.get(view.id(), None)
+        if tracked is not None:
+            edit = tracked[1]
+            for change in changes:
+                edit = mergeEdits(edit, change.a.pt, change.b.pt, len(change.str))
+            pending_edits[view.id()] = (view.change_count(), edit)
+
+def updateTreesIncrementally(view, change_count):
+    """If all the changes made to the view since it was last parsed are inside a single element, parse only that element again and splice it into the existing tree. Return True if successful."""
+    if not getBoolValueFromArgsOrSettings('incremental_parsing', None, True):
+        return False
+    if running_queries.get(view.id(), 0) > 0: # a query is being evaluated on the trees in another thread, so rather than modify them, parse the whole document again into new trees
+        return False
+    
+    global pending_edits
+    with pending_edits_lock:
+        tracked = pending_edits.get(view.id(), None)
+    if tracked is None or tracked[0] != change_count or tracked[1] is None: # if the changes weren't tracked
+        return False
+    begin, end, delta = tracked[1]
+    
+    global xml_roots
+    roots = xml_roots.get(view.id(), None)
+    regions = getSGMLRegions(view)
+    if not roots or None in roots or len(regions) != len(roots): # if there were parse errors or the SGML regions have changed
+        return False
+    
+    # find the innermost element that contains the changes
+    node = None
+    for region_index, root in enumerate(roots):
+        node = getSmallestElementContaining(root, begin, end)
+        if node is not None:
+            break
+    if node is None or node.getparent() is None: # the root element itself can't be replaced
+        return False
+    tag_positions = roots[region_index].tag_positions
+    if tag_positions.unused > len(tag_positions) // 2: # rather than let the positions of replaced nodes accumulate, parse the whole document again
+        return False
+    
+    fragment_region = sublime.Region(getNodeTagRange(node, 'open')[0], getNodeTagRange(node, 'close')[1] + delta)
+    if not regions[region_index].contains(fragment_region):
+        return False
+    
+    try:
+        element, fragment_tag_positions, fragment_name_index = lxml_etree_parse_xml_fragment_with_location(region_chunks(view, fragment_region, chunk_size_for_region(fragment_region, settings.get('parse_chunk_size', 0))), fragment_region.begin(), node.getparent().nsmap)
+    except (etree.XMLSyntaxError, ValueError):
+        return False # let the full parse report the error
+    if getNamespaceDeclarations(element) != getNamespaceDeclarations(node): # namespace declarations affect the unique prefixes for the whole document
+        return False
+    
+    # move everything after the changes by the difference in size, then replace the old element with the new one
+    for index, root in enumerate(roots):
+        root.tag_positions.shift(end, delta, node.iterancestors() if index == region_index else ())
+    removed = list(node.iter())
+    tag_positions.remove(removed)
+    if hasattr(roots[region_index], 'name_index'): # otherwise, it will be built from the updated tree when it is needed
+        roots[region_index].name_index.remove(removed)
+        roots[region_index].name_index.extend(fragment_name_index)
+    element.tail = node.tail
+    node.getparent().replace(node, element)
+    tag_positions.extend(fragment_tag_positions)
+    clear_path_caches_for_tree(roots[region_index].getroottree())
+    for root in roots: # the positions of the children have moved
+        clearChildSpans(root)
+    
+    with pending_edits_lock:
+        pending_edits[view.id()] = (change_count, None)
+    return True
 
 class GotoXmlParseErrorCommand(sublime_plugin.TextCommand):
     def run(self, edit, **args):
@@ -154,7 +514,7 @@ def getXPathOfNodes(nodes, args):
     def getTagNameWithMappedPrefix(node, namespaces):
         tag = getTagName(node)
         if show_namespace_prefixes_from_query and tag[0] is not None: # if the element belongs to a namespace
-            unique_prefix = next((prefix for prefix in namespaces.keys() if namespaces[prefix] == (tag[0], node.prefix)), None) # find the first prefix in the map that relates to this uri
+            unique_prefix = namespaces[0].get((tag[0], node.prefix), None) # find the first prefix in the map that relates to this uri
             if unique_prefix is not None:
                 tag = (tag[0], tag[1], unique_prefix + ':' + tag[1]) # ensure that the path we display can be used to query the element
         
@@ -163,34 +523,36 @@ def getXPathOfNodes(nodes, args):
         
         return tag
     
-    def getNodePathPart(node, namespaces):
+    def getSiblingOrdinal(node, root):
+        """Return the position of the element among its siblings with the same name, and whether there are other siblings with that name."""
+        parent = node.getparent()
+        if parent is None: # the root element has no element siblings
+            return (1, False)
+        
+        sibling_ordinals = path_caches_for_tree(root.getroottree())[0]
+        parent_key = (getNodeKey(parent), case_sensitive)
+        ordinals = sibling_ordinals.get(parent_key, None)
+        if ordinals is None:
+            # number all the children of the parent in one pass, so that each sibling only needs a lookup
+            counts = {}
+            tags = {}
+            for child in parent.iterchildren(tag = etree.Element): # skip comments
+                tag = getTagName(child)
+                if not case_sensitive:
+                    tag = (tag[0], tag[1].lower(), tag[2].lower())
+                counts[tag] = counts.get(tag, 0) + 1
+                tags[getNodeKey(child)] = (tag, counts[tag])
+            ordinals = { key: (ordinal, counts[tag] > 1) for key, (tag, ordinal) in tags.items() } # namespace uri, prefix and tag name must all match
+            sibling_ordinals[parent_key] = ordinals
+        return ordinals[getNodeKey(node)]
+    
+    def getNodePathPart(node, namespaces, root):
         tag = getTagNameWithMappedPrefix(node, namespaces)
         
         output = tag[2]
         
         if include_indexes:
-            siblings = node.itersiblings(preceding = True)
-            index = 1
-            
-            def compare(sibling):
-                if not isinstance(sibling, LocationAwareElement): # skip comments
-                    return False
-                sibling_tag = getTagNameWithMappedPrefix(sibling, namespaces)
-                return sibling_tag == tag # namespace uri, prefix and tag name must all match
-            
-            for sibling in siblings:
-                if compare(sibling):
-                    index += 1
-            
-            # if there are no previous sibling matches, check next siblings to see if we should index this node
-            multiple = index > 1
-            if not multiple:
-                siblings = node.itersiblings()
-                for sibling in siblings:
-                    if compare(sibling):
-                        multiple = True
-                        break
-            
+            index, multiple = getSiblingOrdinal(node, root)
             if multiple:
                 output += '[' + str(index) + ']'
         
@@ -216,17 +578,31 @@ def getXPathOfNodes(nodes, args):
         
         return output
     
-    def getNodePathSegments(node, namespaces, root):
+    # the options that affect the path of a node, so that paths computed with different options are cached separately
+    path_options = (include_indexes, include_attributes, show_namespace_prefixes_from_query, case_sensitive, all_attributes, tuple(wanted_attributes))
+    
+    def getNodePath(node, namespaces, root):
         if isinstance(node, etree.CommentBase):
             node = node.getparent()
-        while node != root:
-            yield getNodePathPart(node, namespaces)
+        
+        node_paths = path_caches_for_tree(root.getroottree())[1]
+        # walk up to the nearest ancestor whose path is already known, then build the paths back down from it
+        uncached = []
+        path = ''
+        while node is not None:
+            cached = node_paths.get((getNodeKey(node), path_options), None)
+            if cached is not None:
+                path = cached
+                break
+            uncached.append(node)
+            if node == root:
+                break
             node = node.getparent()
-        yield getNodePathPart(node, namespaces)
-        yield ''
-    
-    def getNodePath(node, namespaces, root):
-        return '/'.join(reversed(list(getNodePathSegments(node, namespaces, root))))
+        
+        for node in reversed(uncached):
+            path += '/' + getNodePathPart(node, namespaces, root)
+            node_paths[(getNodeKey(node), path_options)] = path
+        return path
     
     roots = {}
     for node in nodes:
@@ -239,7 +615,7 @@ def getXPathOfNodes(nodes, args):
         for node in roots[root]:
             namespaces = None
             if show_namespace_prefixes_from_query:
-                namespaces = namespace_map_for_tree(root.getroottree())
+                namespaces = unique_prefixes_for_tree(root.getroottree())
             
             paths.append(getNodePath(node, namespaces, root))
     
@@ -257,29 +633,38 @@ def updateStatusToCurrentXPathIfSGML(view):
     status = None
     if isCursorInsideSGML(view):
         if not getBoolValueFromArgsOrSettings('only_show_xpath_if_saved', None, False) or not view.is_dirty() or view.is_read_only():
-            trees = ensureTreeCacheIsCurrent(view)
-            if trees is None: # don't hide parse errors by overwriting status
+            trees = ensureTreeCacheIsCurrent(view, False)
+            if trees is None: # the status will be updated when parsing finishes
                 return
             else:
-                # use cache of previous first selection if it exists
+                # use cache of previous first selections if it exists
                 global previous_first_selection
-                prev = previous_first_selection[view.id()]
+                recent = previous_first_selection[view.id()]
+                if recent is None:
+                    recent = collections.OrderedDict()
+                    previous_first_selection[view.id()] = recent
                 
                 current_first_sel = view.sel()[0]
-                nodes = []
-                if prev is not None and regionIntersects(prev[0], sublime.Region(current_first_sel.begin(), current_first_sel.begin()), False): # current first selection matches xpath region from previous first selection
-                    nodes.append(prev[1])
-                else: # current first selection doesn't match xpath region from previous first selection or is not cached
+                cursor = sublime.Region(current_first_sel.begin(), current_first_sel.begin())
+                xpath = None
+                for span in reversed(recent): # check the most recently used first
+                    if regionIntersects(sublime.Region(*span), cursor, False): # current first selection matches xpath region from a previous first selection
+                        recent.move_to_end(span)
+                        xpath = recent[span][1]
+                        break
+                else: # current first selection doesn't match xpath region from previous first selections or is not cached
                     results = getNodesAtPositions(view, trees, [current_first_sel]) # get nodes at first selection
                     if len(results) > 0:
                         result = results[0]
-                        previous_first_selection[view.id()] = (sublime.Region(result[2], result[3]), result[0]) # cache node and xpath region
-                        nodes.append(result[0])
+                        # calculate xpath of node
+                        xpaths = getXPathOfNodes([result[0]], None)
+                        if len(xpaths) == 1:
+                            xpath = xpaths[0]
+                            recent[(result[2], result[3])] = (result[0], xpath) # cache node, xpath and xpath region
+                            if len(recent) > RECENT_FIRST_SELECTIONS: # forget the least recently used
+                                recent.popitem(last = False)
                 
-                # calculate xpath of node
-                xpaths = getXPathOfNodes(nodes, None)
-                if len(xpaths) == 1:
-                    xpath = xpaths[0]
+                if xpath is not None:
                     intro = 'XPath'
                     if len(view.sel()) > 1:
                         intro = intro + ' (at first selection)'
@@ -296,6 +681,51 @@ def updateStatusToCurrentXPathIfSGML(view):
     else:
         view.set_status('xpath', status)
 
+class StatusUpdateScheduler:
+    """Coalesce requests to update the status bar of each view, so that when the selection changes faster than the xpath at the cursor can be found, i.e. while an arrow key is held down, the superseded requests are dropped instead of queueing up behind each other. Updates for a view happen at most once per interval, and always reflect the selection at the time they run, so the last one shows the latest cursor position."""
+    def __init__(self):
+        self.requested = 0
+        self.executed = 0
+        self.dropped = 0
+        self._pending = {} # views that have an update scheduled, by view id
+        self._last_run = {} # when the status of each view was last updated, by view id
+        self._lock = threading.Lock()
+    
+    def request(self, view):
+        """Update the status bar of the view soon, unless an update is already scheduled."""
+        global settings
+        with self._lock:
+            self.requested += 1
+            if view.id() in self._pending: # the scheduled update will see the latest selection
+                self.dropped += 1
+                return
+            self._pending[view.id()] = view
+            interval = settings.get('status_update_interval', 50) / 1000
+            delay = max(self._last_run.get(view.id(), 0) + interval - time.perf_counter(), 0)
+        sublime.set_timeout_async(lambda: self._run(view.id()), int(delay * 1000))
+    
+    def _run(self, view_id):
+        with self._lock:
+            view = self._pending.pop(view_id, None)
+            if view is None: # the view was closed
+                return
+            self.executed += 1
+        try:
+            updateStatusToCurrentXPathIfSGML(view)
+        finally:
+            with self._lock:
+                self._last_run[view_id] = time.perf_counter() # measure the interval from the end of the update, so that slow updates can't hog the async thread
+    
+    def forget(self, view_id):
+        with self._lock:
+            self._pending.pop(view_id, None)
+            self._last_run.pop(view_id, None)
+    
+    def __str__(self):
+        return str(self.requested) + ' requested, ' + str(self.executed) + ' executed, ' + str(self.dropped) + ' dropped as superseded'
+
+status_updates = StatusUpdateScheduler()
+
 def copyXPathsToClipboard(view, args):
     """Copy the XPath(s) at the cursor(s) to the clipboard."""
     if isCursorInsideSGML(view):
@@ -408,24 +838,37 @@ def getUniqueItems(items):
 
 class XpathListener(sublime_plugin.EventListener):
     def on_selection_modified_async(self, view):
-        updateStatusToCurrentXPathIfSGML(view)
+        status_updates.request(view)
     
     def on_activated_async(self, view):
-        updateStatusToCurrentXPathIfSGML(view)
+        status_updates.request(view)
     
     def on_post_save_async(self, view):
         if getBoolValueFromArgsOrSettings('only_show_xpath_if_saved', None, False):
-            updateStatusToCurrentXPathIfSGML(view)
+            status_updates.request(view)
     
     def on_pre_close(self, view):
         global change_counters
         global xml_roots
-        global xml_elements
         global previous_first_selection
-        change_counters.pop(view.id(), None)
-        xml_roots.pop(view.id(), None)
-        xml_elements.pop(view.id(), None)
-        previous_first_selection.pop(view.id(), None)
+        global sgml_regions
+        global pending_edits
+        cancelParse(view.id())
+        with trees_lock:
+            change_counters.pop(view.id(), None)
+            xml_roots.pop(view.id(), None)
+            previous_first_selection.pop(view.id(), None)
+            sgml_regions.pop(view.id(), None)
+        with pending_edits_lock:
+            pending_edits.pop(view.id(), None)
+        dropQueryResults(view.id())
+        status_updates.forget(view.id())
+        query_costs.pop(view.id(), None)
+        with query_evaluations_lock: # a running evaluation finishes by itself, but a queued one doesn't need to start
+            running, queued = query_evaluations.pop(view.id(), (None, None))
+            background_query_evaluations.pop(view.id(), None)
+        if queued is not None:
+            queued.drop()
         
         if view.file_name() is None: # if the file has no filename associated with it
             #if not getBoolValueFromArgsOrSettings('global_query_history', None, True): # if global history isn't enabled
@@ -433,15 +876,57 @@ class XpathListener(sublime_plugin.EventListener):
             #else:
             change_key_for_xpath_query_history(get_history_key_for_view(view), 'global')
 
+if hasattr(sublime_plugin, 'TextChangeListener'): # only available from Sublime Text 4, which reports exactly what changed. Without it, the whole document is parsed again after each modification
+    class XpathTextChangeListener(sublime_plugin.TextChangeListener):
+        @classmethod
+        def is_applicable(cls, buffer):
+            return True # otherwise it is never attached. Changes are only recorded for views whose trees have been built
+        
+        def on_text_changed(self, changes):
+            for view in self.buffer.views():
+                recordTextChanges(view, changes)
+
+XML_NAMESPACE = 'http://www.w3.org/XML/1998/namespace'
+RE_XPATH_NUMBER = re.compile(r'\s*(-?(?:\d+(?:\.\d*)?|\.\d+))\s*$')
+RE_XPATH_REPLACEMENT = re.compile(r'\\([\\$])|\$(\d)')
+RE_XPATH_DATE_TIME = re.compile(r'\s*(?:(-?\d{4,})-(\d\d)-(\d\d)(?:T|(?=[Z+-]|\s*$)))?(?:(\d\d):(\d\d):(\d\d(?:\.\d+)?))?(?:Z|[+-]\d\d:\d\d)?\s*$') # an xs:dateTime, xs:date or xs:time value
+
 def register_xpath_extensions():
     # http://lxml.de/extensions.html
     ns = etree.FunctionNamespace(None)
     
-    def applyFuncToTextForItem(item, func):
-        if isinstance(item, etree._Element):
-            return func(item.xpath('string(.)'))
+    def getStringValue(item):
+        """Return the XPath string value of the item, without executing a query for it."""
+        if isinstance(item, (etree._Comment, etree._ProcessingInstruction)):
+            return item.text or ''
+        elif isinstance(item, etree._Element):
+            return ''.join(item.itertext()) # the text of the element and its descendants, excluding comments and processing instructions
+        elif isinstance(item, list): # a nodeset given where a string is expected is converted using its first node
+            return getStringValue(item[0]) if len(item) > 0 else ''
+        elif isinstance(item, bool):
+            return 'true' if item else 'false'
+        elif isinstance(item, float) and item.is_integer():
+            return str(int(item))
         else:
-            return func(str(item))
+            return str(item)
+    
+    def getNumberValue(item):
+        """Return the number that the item converts to, as with the XPath number function."""
+        if isinstance(item, (bool, float)):
+            return float(item)
+        match = RE_XPATH_NUMBER.match(getStringValue(item))
+        if match is None:
+            return float('nan')
+        return float(match.group(1))
+    
+    def getItems(sequence):
+        """Return the items in the sequence as a list, so that a single value is treated as a sequence of one string."""
+        if isinstance(sequence, list):
+            return sequence
+        return [getStringValue(sequence)] # lxml can only return nodes and strings in a nodeset
+    
+    def applyFuncToTextForItem(item, func):
+        return func(getStringValue(item))
     
     # TODO: xpath 1 functions deal with lists by just taking the first node
     #     - maybe we can provide optional arg to return nodeset by applying to all
@@ -480,6 +965,7 @@ def register_xpath_extensions():
     ns['print'] = printValueAndReturnUnchanged
     
     def xpathRegexFlagsToPythonRegexFlags(xpath_regex_flags):
+        xpath_regex_flags = xpath_regex_flags or ''
         flags = 0
         if 's' in xpath_regex_flags:
             flags = flags | re.DOTALL
@@ -492,15 +978,116 @@ def register_xpath_extensions():
         
         return flags
     
-    ns['tokenize'] = lambda context, item, pattern, xpath_regex_flags = None: applyFuncToTextForItem(item, lambda text: re.split(pattern, text, maxsplit = 0, flags = xpathRegexFlagsToPythonRegexFlags(xpath_regex_flags)))
-    ns['matches'] = lambda context, item, pattern, xpath_regex_flags = None: applyFuncToTextForItem(item, lambda text: re.search(pattern, text, flags = xpathRegexFlagsToPythonRegexFlags(xpath_regex_flags)) is not None)
-    # replace
-    # avg
-    # min
-    # max
-    # abs
-    # ? adjust-dateTime-to-timezone, current-dateTime, day-from-dateTime, month-from-dateTime, days-from-duration, months-from-duration, etc.
-    # insert-before, remove, subsequence, index-of, distinct-values, reverse, unordered, empty, exists
+    @functools.lru_cache(maxsize = 256)
+    def compileXPathRegex(pattern, xpath_regex_flags):
+        """Compile the regular expression once, rather than each time the function is called for a node in a predicate."""
+        return re.compile(pattern, xpathRegexFlagsToPythonRegexFlags(xpath_regex_flags))
+    
+    def getXPathRegex(pattern, xpath_regex_flags):
+        return compileXPathRegex(getStringValue(pattern), getStringValue(xpath_regex_flags or ''))
+    
+    ns['tokenize'] = lambda context, item, pattern, xpath_regex_flags = None: getXPathRegex(pattern, xpath_regex_flags).split(getStringValue(item))
+    ns['matches'] = lambda context, item, pattern, xpath_regex_flags = None: getXPathRegex(pattern, xpath_regex_flags).search(getStringValue(item)) is not None
+    
+    def getXPathReplacement(replacement):
+        """Convert an XPath 2.0 replacement string, which refers to groups with $1 and escapes $ and \\ with a backslash, to a Python one."""
+        def convert(match):
+            if match.group(1) == '$':
+                return '$'
+            elif match.group(1) == '\\':
+                return '\\\\'
+            else:
+                return '\\g<' + match.group(2) + '>'
+        return RE_XPATH_REPLACEMENT.sub(convert, replacement)
+    
+    ns['replace'] = lambda context, nodes, pattern, replacement, xpath_regex_flags = None: applyTransformFuncToTextForItems(nodes, lambda text: getXPathRegex(pattern, xpath_regex_flags).sub(getXPathReplacement(getStringValue(replacement)), text))
+    
+    def aggregateNumbers(sequence, combine, finish = lambda total, count: total):
+        """Combine the numeric values of the items in the sequence in a single pass. Return an empty nodeset for an empty sequence, and NaN if any of the items isn't a number."""
+        total = None
+        count = 0
+        for item in getItems(sequence):
+            number = getNumberValue(item)
+            if math.isnan(number):
+                return number
+            total = number if total is None else combine(total, number)
+            count += 1
+        if total is None:
+            return []
+        return finish(total, count)
+    
+    ns['avg'] = lambda context, sequence: aggregateNumbers(sequence, lambda total, number: total + number, lambda total, count: total / count)
+    ns['min'] = lambda context, sequence: aggregateNumbers(sequence, min)
+    ns['max'] = lambda context, sequence: aggregateNumbers(sequence, max)
+    ns['abs'] = lambda context, number: abs(getNumberValue(number))
+    
+    def distinctValues(context, sequence):
+        """Return the distinct string values of the items in the sequence, in the order they first occur. Unlike the XPath 1.0 equivalent, i.e. `//x[not(. = preceding::x)]`, this doesn't compare each item to all the ones before it."""
+        seen = set()
+        values = []
+        for item in getItems(sequence):
+            value = getStringValue(item)
+            if value not in seen:
+                seen.add(value)
+                values.append(value)
+        return values
+    
+    def indexOf(context, sequence, search):
+        """Return the positions of the items in the sequence that are equal to the search value, as strings because lxml can't return a nodeset of numbers."""
+        if isinstance(search, float):
+            matches = lambda item: getNumberValue(item) == search
+        else:
+            search = getStringValue(search)
+            matches = lambda item: getStringValue(item) == search
+        return [str(position) for position, item in enumerate(getItems(sequence), 1) if matches(item)]
+    
+    def roundXPathNumber(number):
+        """Round the number like the XPath round function, which rounds halves up."""
+        if math.isnan(number) or math.isinf(number):
+            return number
+        return math.floor(number + 0.5)
+    
+    def subsequence(context, sequence, start, length = None):
+        start = roundXPathNumber(getNumberValue(start))
+        end = float('inf') if length is None else start + roundXPathNumber(getNumberValue(length))
+        return [item for position, item in enumerate(getItems(sequence), 1) if start <= position < end]
+    
+    def insertBefore(context, sequence, position, inserts):
+        """Return the string values of the items with the inserted ones before the given position. Nodes would be put back in document order by lxml, which would lose the position."""
+        items = [getStringValue(item) for item in getItems(sequence)]
+        position = roundXPathNumber(getNumberValue(position))
+        position = 1 if math.isnan(position) else int(min(max(position, 1), len(items) + 1))
+        items[position - 1:position - 1] = [getStringValue(item) for item in getItems(inserts)]
+        return items
+    
+    def remove(context, sequence, position):
+        position = roundXPathNumber(getNumberValue(position))
+        return [item for index, item in enumerate(getItems(sequence), 1) if index != position]
+    
+    ns['distinct-values'] = distinctValues
+    ns['index-of'] = indexOf
+    ns['subsequence'] = subsequence
+    ns['insert-before'] = insertBefore
+    ns['remove'] = remove
+    ns['reverse'] = lambda context, sequence: [getStringValue(item) for item in reversed(getItems(sequence))] # string values, because lxml puts any nodes returned by an extension function back in document order
+    ns['unordered'] = lambda context, sequence: getItems(sequence)
+    ns['exists'] = lambda context, sequence: len(getItems(sequence)) > 0
+    ns['empty'] = lambda context, sequence: len(getItems(sequence)) == 0
+    
+    def getDateTimeComponent(value, group):
+        """Return a component of an xs:date, xs:dateTime or xs:time value as a number, or an empty nodeset if the value isn't one or doesn't have the component."""
+        match = RE_XPATH_DATE_TIME.match(getStringValue(value))
+        if match is None or match.group(group) is None:
+            return []
+        return float(match.group(group))
+    
+    for name, group in (('year', 1), ('month', 2), ('day', 3)):
+        ns[name + '-from-date'] = ns[name + '-from-dateTime'] = lambda context, value, group = group: getDateTimeComponent(value, group)
+    for name, group in (('hours', 4), ('minutes', 5), ('seconds', 6)):
+        ns[name + '-from-dateTime'] = ns[name + '-from-time'] = lambda context, value, group = group: getDateTimeComponent(value, group)
+    ns['current-dateTime'] = lambda context: datetime.datetime.now(datetime.timezone.utc).astimezone().isoformat()
+    ns['current-date'] = lambda context: ns['current-dateTime'](context)[0:10]
+    # ? adjust-dateTime-to-timezone, days-from-duration, months-from-duration, etc.
     
 
 def plugin_loaded():
@@ -514,15 +1101,20 @@ def plugin_loaded():
     register_xpath_extensions()
 
 def plugin_unloaded():
+    for view_id in list(parse_jobs.keys()):
+        cancelParse(view_id)
+    global region_parse_pool
+    if region_parse_pool is not None:
+        region_parse_pool.shutdown(wait=False)
+        region_parse_pool = None
     for view in sublime.active_window().views():
         view.erase_status('xpath')
         view.erase_status('xpath_error')
     global settings
     settings.clear_on_change('reparse')
 
-def get_results_for_xpath_query_multiple_trees(query, tree_contexts, root_namespaces, **additional_variables):
-    """Given a query string and a dictionary of document trees and their context elements, compile the xpath query and execute it for each document."""
-    matches = []
+def xpath_query_arguments_for_trees(tree_contexts, root_namespaces, additional_variables):
+    """Given a dictionary of document trees and their context elements, return a generator of the tree, context element, namespaces and variables to execute an xpath query with for each document."""
     global settings
     variables = settings.get('variables', {})
     for key in additional_variables:
@@ -534,9 +1126,211 @@ def get_results_for_xpath_query_multiple_trees(query, tree_contexts, root_namesp
         context = None
         if len(tree_contexts[tree]) > 0:
             context = tree_contexts[tree][0]
-        matches += get_results_for_xpath_query(query, tree, context, namespaces, **variables)
+        yield (tree, context, namespaces, variables)
+
+def get_results_for_xpath_query_multiple_trees(query, tree_contexts, root_namespaces, max_results = None, **additional_variables):
+    """Given a query string and a dictionary of document trees and their context elements, compile the xpath query and execute it for each document. If max_results is given, stop once that many results have been found."""
+    matches = []
+    for tree, context, namespaces, variables in xpath_query_arguments_for_trees(tree_contexts, root_namespaces, additional_variables):
+        remaining = None
+        if max_results is not None:
+            remaining = max_results - len(matches)
+            if remaining <= 0:
+                break
+        matches += get_results_for_xpath_query(query, tree, context, namespaces, remaining, **variables)
         
     return matches
+
+def count_results_for_xpath_query_multiple_trees(query, tree_contexts, root_namespaces, **additional_variables):
+    """Given a query string that returns a node-set and a dictionary of document trees and their context elements, return the total number of nodes the query returns for all the documents."""
+    return sum(count_results_for_xpath_query(query, tree, context, namespaces, **variables) for tree, context, namespaces, variables in xpath_query_arguments_for_trees(tree_contexts, root_namespaces, additional_variables))
+
+def get_results_for_xpath_query_in_view(view, change_count, query, tree_contexts, root_namespaces, max_results = None):
+    """Return the results of the query for the trees and context nodes, reusing the results from the last time the same query was executed with the same context nodes, variables and maximum number of results, if the view hasn't been modified since."""
+    global settings
+    key = (query, max_results, tuple((getNodeKey(tree.getroot()), tuple(getNodeKey(node) for node in tree_contexts[tree])) for tree in tree_contexts.keys()), repr(sorted(settings.get('variables', {}).items())))
+    with query_results_lock:
+        cached = query_results.get(view.id(), None)
+        if cached is not None and cached[0] == change_count and key in cached[1]:
+            cached[1].move_to_end(key)
+            return list(cached[1][key])
+    
+    results = get_results_for_xpath_query_multiple_trees(query, tree_contexts, root_namespaces, max_results)
+    
+    max_cached = settings.get('max_cached_query_results', 100000)
+    if max_cached > 0 and len(results) <= max_cached and view.change_count() == change_count:
+        with query_results_lock:
+            cached = query_results.get(view.id(), None)
+            if cached is None or cached[0] != change_count:
+                cached = (change_count, collections.OrderedDict())
+                query_results[view.id()] = cached
+            cached[1][key] = results
+            # forget the least recently used results until the total number of results cached for the view is within the limit
+            total = sum(len(value) for value in cached[1].values())
+            while total > max_cached:
+                total -= len(cached[1].popitem(last = False)[1])
+    return list(results)
+
+class QueryEvaluation:
+    """Evaluate an xpath query on the trees of a view in a background thread. lxml can't interrupt an evaluation, so an evaluation that nobody is waiting for still runs to completion - and while it runs, the trees are parsed again instead of being modified. So that they don't pile up, only one query is evaluated at a time for each view, see requestQueryEvaluation."""
+    def __init__(self, view_id, key, evaluate):
+        self.view_id = view_id
+        self.key = key
+        self.evaluate = evaluate
+        self.started = False
+        self.finished = threading.Event()
+        self.elapsed = None # how many milliseconds the evaluation took
+        self.requests = []
+        self._results = None
+        self._error = None
+    
+    def start(self):
+        """Start the evaluation, once it has been marked as started while holding the lock, so that it is only started once."""
+        with trees_lock:
+            running_queries[self.view_id] = running_queries.get(self.view_id, 0) + 1
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+    
+    def run(self):
+        start = time.perf_counter()
+        try:
+            self._results = self.evaluate()
+        except Exception as e:
+            self._error = e
+        finally:
+            self.elapsed = (time.perf_counter() - start) * 1000
+            with trees_lock:
+                running_queries[self.view_id] -= 1
+                if running_queries[self.view_id] == 0:
+                    del running_queries[self.view_id]
+            queued = None
+            with query_evaluations_lock:
+                self.finished.set()
+                requests = self.requests
+                if self.view_id in query_evaluations and query_evaluations[self.view_id][0] is self: # start the next query, if one is waiting
+                    queued = query_evaluations[self.view_id][1]
+                    if queued is None:
+                        del query_evaluations[self.view_id]
+                    else:
+                        query_evaluations[self.view_id] = (queued, None)
+                        queued.started = True
+                elif background_query_evaluations.get(self.view_id, None) is self:
+                    del background_query_evaluations[self.view_id]
+            if queued is not None:
+                queued.start()
+        for request in requests:
+            request.wake()
+    
+    def drop(self):
+        """Give up on an evaluation that hasn't started, waking whoever is waiting for it."""
+        for request in self.requests:
+            request.abandon()
+    
+    def results(self):
+        """Return the results of the finished evaluation, or raise the exception it raised."""
+        if self._error is not None:
+            raise self._error
+        return self._results
+
+class QueryRequest:
+    """A request for the results of a query evaluation, which whoever made it can stop waiting for, i.e. when it is taking too long or the query has changed."""
+    def __init__(self, evaluation, finished_callback = None):
+        self.evaluation = evaluation
+        self.abandoned = False
+        self._finished_callback = finished_callback
+        self._woken = threading.Event()
+    
+    @property
+    def elapsed(self):
+        return self.evaluation.elapsed
+    
+    def wake(self):
+        self._woken.set()
+        if self._finished_callback is not None and not self.abandoned:
+            self._finished_callback(self)
+    
+    def wait(self, timeout = None):
+        """Wait for at most timeout seconds for the evaluation to finish, unless the request is abandoned first. Return True if it finished."""
+        self._woken.wait(timeout)
+        return self.evaluation.finished.is_set() and not self.abandoned
+    
+    def abandon(self):
+        self.abandoned = True
+        self._woken.set()
+    
+    def is_waiting_for_previous_query(self):
+        return not self.evaluation.started
+    
+    def results(self):
+        return self.evaluation.results()
+
+def requestQueryEvaluation(view, key, evaluate, finished_callback = None):
+    """Return a request for the results of evaluating a query on the trees of the view, where the key identifies the query and the context it is evaluated in. If the same query is already being evaluated, the request waits for its results. If a different one is, the evaluation is queued until it has finished, replacing any evaluation that was already queued, so that at most one abandoned evaluation per view uses the CPU."""
+    global query_evaluations
+    view_id = view.id()
+    with query_evaluations_lock:
+        running, queued = query_evaluations.get(view_id, (None, None))
+        if running is not None and running.key == key:
+            evaluation = running
+        elif queued is not None and queued.key == key:
+            evaluation = queued
+        else:
+            evaluation = QueryEvaluation(view_id, key, evaluate)
+            if running is None:
+                running = evaluation
+            else:
+                if queued is not None:
+                    queued.drop()
+                queued = evaluation
+            query_evaluations[view_id] = (running, queued)
+        request = QueryRequest(evaluation, finished_callback)
+        evaluation.requests.append(request) # evaluations are removed from query_evaluations as they finish, so this one hasn't yet
+        start = evaluation is running and not evaluation.started
+        if start:
+            evaluation.started = True
+    if start:
+        evaluation.start()
+    return request
+
+
+def startBackgroundQueryEvaluation(view, evaluate, finished_callback, is_wanted, delay):
+    """Evaluate a query whose results nobody waits for, i.e. to count all the results of one that was truncated, outside of the queue of queries for the view, so that it doesn't hold up the next one. It starts after the delay in milliseconds, unless is_wanted returns False by then, i.e. because the query has been changed - and not at all if another one is still running for the view, since it can't be interrupted."""
+    def start():
+        if not is_wanted():
+            return
+        with query_evaluations_lock:
+            if view.id() in background_query_evaluations:
+                return
+            evaluation = QueryEvaluation(view.id(), None, evaluate)
+            evaluation.started = True
+            evaluation.requests.append(QueryRequest(evaluation, finished_callback))
+            background_query_evaluations[view.id()] = evaluation
+        evaluation.start()
+    
+    sublime.set_timeout_async(start, delay)
+
+def recordQueryCost(view_id, elapsed):
+    """Update the exponentially weighted moving average of how many milliseconds queries on the view take to evaluate."""
+    global query_costs
+    average = query_costs.get(view_id, None)
+    if average is None:
+        average = elapsed
+    else:
+        average += QUERY_COST_WEIGHT * (elapsed - average)
+    query_costs[view_id] = average
+
+def getLiveQueryDelay(view_id):
+    """Return how many milliseconds to wait after the query is changed in live mode before evaluating it. The more expensive recent queries on the view have been, the longer the wait, so that expensive queries aren't evaluated for every keystroke, while cheap ones still are."""
+    global settings
+    minimum = settings.get('live_query_min_delay', settings.get('live_query_delay', 0))
+    maximum = settings.get('live_query_max_delay', 500)
+    return int(min(max(query_costs.get(view_id, 0), minimum), maximum))
+
+def dropQueryResults(view_id):
+    """Forget the query results cached for the view, i.e. because it has been parsed again."""
+    with query_results_lock:
+        query_results.pop(view_id, None)
     
 def get_xpath_query_history_for_keys(keys):
     """Return all previously used xpath queries with any of the given keys, in order.  If keys is None, return history across all keys."""
@@ -647,12 +1441,46 @@ def namespace_map_for_tree(tree):
         global settings
         defaultNamespacePrefix = settings.get('default_namespace_prefix', 'default')
         root.unique_namespaces = unique_namespace_prefixes(root.all_namespaces, defaultNamespacePrefix)
+        
+        # build the reverse map at the same time, so that the prefix to use for a node can be looked up without searching through the namespaces
+        prefixes_by_original = {}
+        prefixes_by_uri = {}
+        for prefix, (uri, original_prefix) in root.unique_namespaces.items():
+            prefixes_by_original.setdefault((uri, original_prefix or None), prefix) # lxml reports the prefix of elements in a default namespace as None, but the parser may have reported it as an empty string
+            prefixes_by_uri.setdefault(uri, prefix)
+        root.unique_prefixes = (prefixes_by_original, prefixes_by_uri)
     return root.unique_namespaces
 
+def unique_prefixes_for_tree(tree):
+    """Return the first unique prefix from the namespace map for the tree for each namespace uri and original prefix, and the first unique prefix for each namespace uri."""
+    namespace_map_for_tree(tree)
+    return tree.getroot().unique_prefixes
+
+def unique_prefix_for_namespace(tree, uri, original_prefix = None):
+    """Return the prefix to use in queries on the tree for the namespace uri, preferring the one mapped for the original prefix, or None if the namespace has no prefix."""
+    prefixes_by_original, prefixes_by_uri = unique_prefixes_for_tree(tree)
+    prefix = prefixes_by_original.get((uri, original_prefix or None), None) or prefixes_by_uri.get(uri, None)
+    if prefix is None and uri == XML_NAMESPACE: # the xml prefix is bound to its namespace without being declared, i.e. for xml:lang
+        prefix = 'xml'
+    return prefix
+
+def path_caches_for_tree(tree):
+    """Return the sibling ordinals and node paths cached for the tree, which are computed lazily by getXPathOfNodes and discarded with the tree."""
+    root = tree.getroot()
+    if not hasattr(root, 'path_caches'):
+        root.path_caches = ({}, {})
+    return root.path_caches
+
+def clear_path_caches_for_tree(tree):
+    """Discard the sibling ordinals and node paths cached for the tree, after its elements have changed."""
+    root = tree.getroot()
+    if hasattr(root, 'path_caches'):
+        del root.path_caches
+
 class SelectResultsFromXpathQueryCommand(sublime_plugin.TextCommand): # example usage from python console: sublime.active_window().active_view().run_command('select_results_from_xpath_query', { 'xpath': '//*', 'goto_element': 'names' })
     def run(self, edit, **kwargs):
         contexts = get_context_nodes_from_cursors(self.view)
-        nodes = get_results_for_xpath_query_multiple_trees(kwargs['xpath'], contexts, namespace_map_from_contexts(contexts))
+        nodes = get_results_for_xpath_query_in_view(self.view, self.view.change_count(), kwargs['xpath'], contexts, namespace_map_from_contexts(contexts))
         
         global settings
         goto_element = settings.get('goto_element', 'open')
@@ -768,9 +1596,13 @@ def get_context_nodes_from_cursors(view):
         
     return contexts
 
+MAX_REMEMBERED_PREVIEWS = 10000 # how many quick panel items for elements to remember, before starting again
+
 class QueryXpathCommand(QuickPanelFromInputCommand): # example usage from python console: sublime.active_window().active_view().run_command('query_xpath', { 'prefill_query': '//prefix:LocalName', 'live_mode': True })
     max_results_to_show = None
     contexts = None
+    evaluation = None
+    element_previews = None # the change count of the view, and the quick panel items for elements that have been shown as results since, by node key
     previous_input = None # remember previous query so that when the user next runs this command, it will be prepopulated
     
     def cache_context_nodes(self):
@@ -818,9 +1650,10 @@ class QueryXpathCommand(QuickPanelFromInputCommand): # example usage from python
         # if previous input is blank, or specifically told to, use path of first cursor. even if live mode enabled, cursor won't move much when activating this command
         if getBoolValueFromArgsOrSettings('prefill_path_at_cursor', self.arguments, False) or not self.arguments['initial_value']:
             global previous_first_selection
-            prev = previous_first_selection.get(self.view.id(), None)
-            if prev is not None:
-                xpaths = getExactXPathOfNodes([prev[1]]) # ensure the path matches this node and only this node
+            recent = previous_first_selection.get(self.view.id(), None)
+            if recent: # if the first selection was in a node
+                node = next(reversed(recent.values()))[0]
+                xpaths = getExactXPathOfNodes([node]) # ensure the path matches this node and only this node
                 self.arguments['initial_value'] = xpaths[0]
         
         self.arguments['label'] = 'enter xpath'
@@ -830,7 +1663,8 @@ class QueryXpathCommand(QuickPanelFromInputCommand): # example usage from python
         self.max_results_to_show = int(self.get_value_from_args('max_results_to_show', settings.get('max_results_to_show', 1000)))
         
         self.arguments['async'] = getBoolValueFromArgsOrSettings('live_query_async', self.arguments, True)
-        self.arguments['delay'] = int(settings.get('live_query_delay', 0))
+        self.arguments['delay'] = getLiveQueryDelay(self.view.id())
+        self.arguments['time_budget'] = int(self.get_value_from_args('live_query_time_budget', settings.get('live_query_time_budget', 1000)))
         self.arguments['live_mode'] = getBoolValueFromArgsOrSettings('live_mode', self.arguments, True)
         
         self.arguments['normalize_whitespace_in_preview'] = getBoolValueFromArgsOrSettings('normalize_whitespace_in_preview', self.arguments, False)
@@ -855,7 +1689,26 @@ class QueryXpathCommand(QuickPanelFromInputCommand): # example usage from python
                 self.cache_context_nodes()
             
             try:
-                results = list((result for result in get_results_for_xpath_query_multiple_trees(query, self.contexts[1], self.contexts[2])))# if not isinstance(result, etree.CommentBase)))
+                max_results = None
+                if self.max_results_to_show > 0:
+                    max_results = self.max_results_to_show + 1 # one more than will be shown, to know whether there are more
+                contexts = self.contexts
+                self.evaluation = requestQueryEvaluation(self.view, ('results', query, max_results, contexts), lambda: get_results_for_xpath_query_in_view(self.view, contexts[0], query, contexts[1], contexts[2], max_results))
+                time_budget = 0
+                if self.live_mode:
+                    time_budget = self.arguments['time_budget']
+                if self.evaluation.wait(time_budget / 1000 if time_budget > 0 else None):
+                    recordQueryCost(self.view.id(), self.evaluation.elapsed)
+                    results = self.evaluation.results()
+                elif self.evaluation.abandoned: # a newer query is about to be evaluated
+                    return None
+                else: # leave the query running in the background, so that, if it finishes, its results will be remembered for when it is executed again
+                    self.evaluation.abandon()
+                    if self.evaluation.is_waiting_for_previous_query():
+                        status_text = 'Query timed out after ' + str(time_budget) + ' ms, waiting for a previous query to finish'
+                    else:
+                        recordQueryCost(self.view.id(), time_budget)
+                        status_text = 'Query timed out after ' + str(time_budget) + ' ms'
             except etree.XPathError as e:
                 last_char = query.rstrip()[-1]
                 if not last_char in ('/', ':', '@', '[', '(', ','): # log exception to console only if might be useful
@@ -864,19 +1717,48 @@ class QueryXpathCommand(QuickPanelFromInputCommand): # example usage from python
                 status_text = e.__class__.__name__ + ': ' + str(e)
             
             if status_text is None: # if there was no error
-                status_text = str(len(results)) + ' result'
-                if len(results) != 1:
-                    status_text += 's'
-                status_text += ' from query'
                 if self.max_results_to_show > 0 and len(results) > self.max_results_to_show:
-                    status_text += ' (showing first ' + str(self.max_results_to_show) + ')'
+                    # only some of the results were found, so count them all afterwards, rather than delay showing the first ones
+                    status_text = self.get_results_status_text('More than ' + str(self.max_results_to_show), True)
                     results = results[0:self.max_results_to_show]
+                    self.view.set_status('xpath_query', status_text) # before the total is shown
+                    startBackgroundQueryEvaluation(self.view, lambda: count_results_for_xpath_query_multiple_trees(query, contexts[1], contexts[2]), lambda request: self.show_total_results(query, contexts, request), lambda: self.is_current_query(query, contexts), self.arguments['delay'])
+                    return results
+                else:
+                    status_text = self.get_results_status_text(len(results), False)
         self.view.set_status('xpath_query', status_text or '')
         return results
     
+    def get_results_status_text(self, total, truncated):
+        status_text = str(total) + ' result'
+        if total != 1:
+            status_text += 's'
+        status_text += ' from query'
+        if truncated:
+            status_text += ' (showing first ' + str(self.max_results_to_show) + ')'
+        return status_text
+    
+    def is_current_query(self, query, contexts):
+        return self.current_value == query and self.contexts is contexts
+    
+    def show_total_results(self, query, contexts, request):
+        """Show the total number of results of the query, once they have been counted, in the status bar if the query is still current."""
+        try:
+            total = request.results()
+        except etree.XPathError:
+            return
+        if self.is_current_query(query, contexts):
+            self.view.set_status('xpath_query', self.get_results_status_text(total, True))
+    
     def get_items_from_input(self):
         return self.get_query_results(self.current_value)
     
+    def input_changed(self, value):
+        self.arguments['delay'] = getLiveQueryDelay(self.view.id())
+        super().input_changed(value)
+        if self.evaluation is not None and self.live_mode: # stop waiting for the results of the previous query
+            self.evaluation.abandon()
+    
     def get_items_to_show_in_quickpanel(self):
         results = self.items
         if results is None:
@@ -895,7 +1777,19 @@ class QueryXpathCommand(QuickPanelFromInputCommand): # example usage from python
         next(unique_types_in_result, None)
         muliple_types_in_result = next(unique_types_in_result, None) is not None
         
-        show_element_preview = lambda e: [getTagName(e)[2], collapseWhitespace(e.text, maxlen), getElementXMLPreview(self.view, e, maxlen)]
+        change_count = self.view.change_count()
+        if self.element_previews is None or self.element_previews[0] != change_count or len(self.element_previews[1]) > MAX_REMEMBERED_PREVIEWS:
+            self.element_previews = (change_count, {})
+        previews = self.element_previews[1]
+        
+        def show_element_preview(e):
+            """Return the quick panel item for the element, reusing it if the element was in the results of a previous query, i.e. while the query is being typed in live mode."""
+            key = getNodeKey(e)
+            preview = previews.get(key, None)
+            if preview is None:
+                preview = [getTagName(e)[2], collapseWhitespace(e.text, maxlen), getElementXMLPreview(self.view, e, maxlen)]
+                previews[key] = preview
+            return preview
         
         def show_preview(item):
             if isinstance(item, etree.ElementBase) and not isinstance(item, etree.CommentBase):
@@ -922,7 +1816,13 @@ class QueryXpathCommand(QuickPanelFromInputCommand): # example usage from python
         add_to_xpath_query_history_for_key(get_history_key_for_view(self.view), self.current_value)
     
     def command_complete(self, cancelled):
+        if self.evaluation is not None:
+            self.evaluation.abandon()
+            self.evaluation = None
+        self.element_previews = None
         self.view.erase_status('xpath_query')
+        if settings.get('log_parse_timings', False):
+            print('XPath: compiled query cache:', compiled_xpath_cache)
         super().command_complete(cancelled)
     
     def show_input_panel(self, initial_value):
@@ -967,13 +1867,38 @@ def completions_for_xpath_query(view, prefix, locations, contexts, namespaces, v
             'string': ['string', 'concat', 'starts-with', 'contains', 'substring-before', 'substring-after', 'substring', 'string-length', 'normalize-space', 'translate'],
             'boolean': ['boolean', 'not', 'true', 'false', 'lang'],
             'number': ['number', 'sum', 'floor', 'ceiling', 'round'],
-            'XPath 2.0': ['upper-case', 'lower-case', 'ends-with', 'tokenize', 'matches'],
+            'XPath 2.0': ['upper-case', 'lower-case', 'ends-with', 'tokenize', 'matches', 'replace', 'avg', 'min', 'max', 'abs', 'distinct-values', 'index-of', 'subsequence', 'insert-before', 'remove', 'reverse', 'unordered', 'exists', 'empty', 'year-from-dateTime', 'month-from-dateTime', 'day-from-dateTime', 'hours-from-dateTime', 'minutes-from-dateTime', 'seconds-from-dateTime', 'year-from-date', 'month-from-date', 'day-from-date', 'hours-from-time', 'minutes-from-time', 'seconds-from-time', 'current-dateTime', 'current-date'],
             'Custom': ['print']
         }
         for key in funcs.keys():
             for completion in funcs[key]:
                 yield (completion + '\t' + key + ' functions', completion + '($1)')
     
+    def elementCompletion(ns, original_prefix, localname, root):
+        """Return the completion for an element with the given name, using the prefix that is mapped to it's namespace for the query."""
+        fullname = localname
+        ns_prefix = ''
+        if ns is not None: # ensure we get the prefix that we have mapped to the namespace for the query
+            ns_prefix = unique_prefix_for_namespace(root.getroottree(), ns, original_prefix)
+            if ns_prefix is None:
+                return None
+            fullname = ns_prefix + ':' + localname
+        if not last_location_step.endswith(':') or last_location_step.endswith('::') or last_location_step.endswith(ns_prefix + ':'): # ensure `prefix :` works correctly and also `different_prefix_to_suggestion:` (note that we don't do this for attributes - attributes are not allowed spaces before the colon, and if the prefix differs when there is no space, Sublime will replace it with the completion anyway)
+            completion = fullname
+        else:
+            completion = localname
+        return (fullname + '\tElement', completion)
+    
+    def attributeCompletion(ns, localname, root):
+        """Return the completion for an attribute with the given name, using the prefix that is mapped to it's namespace for the query."""
+        attrname = localname
+        if ns is not None:
+            ns_prefix = unique_prefix_for_namespace(root.getroottree(), ns)
+            if ns_prefix is None:
+                return None
+            attrname = ns_prefix + ':' + attrname
+        return (attrname + '\tAttribute', attrname)
+    
     completions = []
     
     variables['contexts'] = None
@@ -1034,51 +1959,58 @@ def completions_for_xpath_query(view, prefix, locations, contexts, namespaces, v
                 tree = list(contexts.keys())[0]
                 completion_contexts = contexts[tree]
                 
-                xpath_variables = variables.copy()
-                xpath_variables['contexts'] = contexts[tree]
-                xpath_variables['expression_contexts'] = None
-                xpath_variables['_prefix'] = prefix
-                
-                for query in subqueries[0:-1] + [exec_query]:
-                    if query != '':
-                        if query[0] not in ('$', '/', '('):
-                            query = '$expression_contexts/' + query
-                        xpath_variables['expression_contexts'] = completion_contexts
-                        try:
-                            completion_contexts = get_results_for_xpath_query(query, tree, None, namespaces[tree.getroot()], **xpath_variables)
-                            # TODO: if result is not a node, break out as we can't offer any useful suggestions (currently we just get an exception: Non-Element values not supported at this point - got 'example string') when it tries $expression_contexts/*
-                        except etree.XPathError as e: # xpath query invalid, just show static contexts
-                            completion_contexts = None
-                            print('XPath: exception obtaining completions for subquery "' + query + '": ' + repr(e))
-                            break
-                
-                if completion_contexts is not None:
-                    for result in completion_contexts:
-                        if isinstance(result, etree._Element): # if it is an Element, add a completion with the full name of the element
-                            ns, localname, fullname = getTagName(result)
-                            ns_prefix = ''
-                            if ns is not None: # ensure we get the prefix that we have mapped to the namespace for the query
-                                root = result.getroottree().getroot()
-                                ns_prefix = next((nsprefix for nsprefix in namespaces[root].keys() if namespaces[root][nsprefix] == (ns, result.prefix))) # find the first prefix in the map that relates to this uri
-                                fullname = ns_prefix + ':' + localname
-                            if not last_location_step.endswith(':') or last_location_step.endswith('::') or last_location_step.endswith(ns_prefix + ':'): # ensure `prefix :` works correctly and also `different_prefix_to_suggestion:` (note that we don't do this for attributes - attributes are not allowed spaces before the colon, and if the prefix differs when there is no space, Sublime will replace it with the completion anyway)
-                                completion = fullname
-                            else:
-                                completion = localname
-                            completions.append((fullname + '\tElement', completion))
-                        elif isinstance(result, etree._ElementUnicodeResult): # if it is an attribute, add a completion with the name of the attribute
-                            if result.is_attribute:
-                                q = etree.QName(result.attrname)
-                                attrname = q.localname
-                                if q.namespace is not None:
-                                    root = result.getparent().getroottree().getroot()
-                                    attrname = next((nsprefix for nsprefix in namespaces[root].keys() if namespaces[root][nsprefix][0] == q.namespace)) + ':' + attrname # find the first prefix in the map that relates to this uri
-                                completions.append((attrname + '\tAttribute', attrname)) # NOTE: can get the value with: result.getparent().get(result.attrname) - in case we ever want to do something fancy like suggest possible values when doing `@attr = *autocomplete*` etc.
-                        else: # debug, are we missing something we could suggest?
-                            #completions.append((str(result) + '\t' + str(type(result)), str(result)))
-                            pass
+                if subqueries[-1] in ('//', '//@'): # all elements or attributes in the document, so suggest the names used in the document without finding every node
+                    root = tree.getroot()
+                    name_index = NameIndex.for_tree(root)
+                    if subqueries[-1] == '//@':
+                        original_prefixes = {}
+                        for ns, original_prefix in namespaces[root].values():
+                            original_prefixes.setdefault(ns, []).append(original_prefix)
+                        for ns, localname in name_index.attribute_names():
+                            names = [localname]
+                            if ns is not None: # attributes in a namespace always have a prefix, even when the namespace is also the default namespace of some elements
+                                names = [original_prefix + ':' + localname for original_prefix in original_prefixes.get(ns, []) + [unique_prefix_for_namespace(root.getroottree(), ns)] if original_prefix]
+                            if any(name.startswith(prefix) for name in names): # the same as starts-with(name(), $_prefix)
+                                completions.append(attributeCompletion(ns, localname, root))
+                    else:
+                        for ns, original_prefix, localname in name_index.element_names():
+                            name = localname if original_prefix is None else original_prefix + ':' + localname
+                            if name.startswith(prefix): # the same as starts-with(name(), $_prefix)
+                                completions.append(elementCompletion(ns, original_prefix, localname, root))
+                    completions = list(getUniqueItems(completion for completion in completions if completion is not None)) # names in namespaces without a prefix can't be completed
+                else:
+                    xpath_variables = variables.copy()
+                    xpath_variables['contexts'] = contexts[tree]
+                    xpath_variables['expression_contexts'] = None
+                    xpath_variables['_prefix'] = prefix
+                    
+                    for query in subqueries[0:-1] + [exec_query]:
+                        if query != '':
+                            if query[0] not in ('$', '/', '('):
+                                query = '$expression_contexts/' + query
+                            xpath_variables['expression_contexts'] = completion_contexts
+                            try:
+                                completion_contexts = get_results_for_xpath_query(query, tree, None, namespaces[tree.getroot()], **xpath_variables)
+                                # TODO: if result is not a node, break out as we can't offer any useful suggestions (currently we just get an exception: Non-Element values not supported at this point - got 'example string') when it tries $expression_contexts/*
+                            except etree.XPathError as e: # xpath query invalid, just show static contexts
+                                completion_contexts = None
+                                print('XPath: exception obtaining completions for subquery "' + query + '": ' + repr(e))
+                                break
                     
-                    completions = list(getUniqueItems(completions))
+                    if completion_contexts is not None:
+                        for result in completion_contexts:
+                            if isinstance(result, etree._Element): # if it is an Element, add a completion with the full name of the element
+                                ns, localname, fullname = getTagName(result)
+                                completions.append(elementCompletion(ns, result.prefix, localname, result.getroottree().getroot()))
+                            elif isinstance(result, etree._ElementUnicodeResult): # if it is an attribute, add a completion with the name of the attribute
+                                if result.is_attribute:
+                                    q = etree.QName(result.attrname)
+                                    completions.append(attributeCompletion(q.namespace, q.localname, result.getparent().getroottree().getroot())) # NOTE: can get the value with: result.getparent().get(result.attrname) - in case we ever want to do something fancy like suggest possible values when doing `@attr = *autocomplete*` etc.
+                            else: # debug, are we missing something we could suggest?
+                                #completions.append((str(result) + '\t' + str(type(result)), str(result)))
+                                pass
+                        
+                        completions = list(getUniqueItems(completion for completion in completions if completion is not None)) # names in namespaces without a prefix can't be completed
         
         if include_generics:
             generics = []